@@ -1,39 +1,124 @@
+from django.conf.urls import patterns, url
 from django.contrib import admin
-from models import UserSubscription, PendingUserSubscription
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from chimpusers.scheduler import priority, BULK
+from chimpusers.stats import get_status_counts, get_optin_counts, \
+                             get_list_ids, EstimatedCountQuerySet
+from models import UserSubscription, PendingUserSubscription, SyncCheckpoint, \
+                   InterestGrouping, MemberActivity
+
+class ListIdFilter(admin.SimpleListFilter):
+    """ Filters by the list IDs cached by chimpusers.stats. """
+    title = 'list ID'
+    parameter_name = 'list_id'
+
+    def lookups(self, request, model_admin):
+        return [(list_id, list_id) for list_id in get_list_ids()]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(list_id=self.value())
 
 class UserSubscriptionAdmin(admin.ModelAdmin):
-    list_display = ('user_email', 'status', 'optin_time', 'optin_ip',)
+    list_display = ('user_email', 'list_id', 'status', 'optin_time', 
+                    'optin_ip',)
     search_fields = ['user__email']
-    list_filter = ('status',)
+    list_filter = ('status', ListIdFilter,)
     actions = ['sync', 'subscribe', 'force_subscribe', 'unsubscribe', 'delete_member']
     # TODO: use confirmation views
     def user_email(self, model):
         return model.user.email
+
+    def queryset(self, request):
+        # the changelist counts the rows twice per page load
+        queryset = super(UserSubscriptionAdmin, self).queryset(request)
+        return queryset._clone(klass=EstimatedCountQuerySet)
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.module_name
+        urls = patterns('',
+            url(r'^summary/$', self.admin_site.admin_view(self.summary_view),
+                name='%s_%s_summary' % info),
+        )
+        return urls + super(UserSubscriptionAdmin, self).get_urls()
+
+    def summary_view(self, request):
+        """ 
+        Subscription counts per status and opt-ins per day of each list, from
+        the cached aggregates of chimpusers.stats. 
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        refresh = bool(request.GET.get('refresh'))
+        lists = []
+        for list_id in get_list_ids(refresh=refresh):
+            statuses = get_status_counts(list_id, refresh=refresh)
+            lists.append({
+                'list_id': list_id,
+                'statuses': [(label, statuses.get(status, 0))
+                             for status, label in UserSubscription.CHOICES],
+                'optins': get_optin_counts(list_id, refresh=refresh),
+            })
+        opts = self.model._meta
+        context = {
+            'title': "%s summary" % opts.verbose_name_plural.capitalize(),
+            'lists': lists,
+            'opts': opts,
+            'app_label': opts.app_label,
+        }
+        template = 'admin/%s/%s/summary.html' % (opts.app_label,
+                                                 opts.object_name.lower())
+        return render_to_response(template, context,
+                                  context_instance=RequestContext(request))
     
     def delete_member(self, request, queryset):
-        for model in queryset:
-            model.unsubscribe(delete_member=True, send_goodbye=False, 
-                              send_notify=False)
+        with priority(BULK):
+            for model in queryset:
+                model.unsubscribe(delete_member=True, send_goodbye=False, 
+                                  send_notify=False)
             
     def force_subscribe(self, request, queryset):
-        for model in queryset:
-            model.subscribe(double_optin=False)
+        with priority(BULK):
+            for model in queryset:
+                model.subscribe(double_optin=False)
             
     def sync(self, request, queryset):
-        for model in queryset:
-            model.sync()
+        with priority(BULK):
+            for model in queryset:
+                model.sync()
             
     def subscribe(self, request, queryset):
-        for model in queryset:
-            model.subscribe()
-    
-    def subscribe(self, request, queryset):
-        for model in queryset:
-            model.subscribe()
+        with priority(BULK):
+            for model in queryset:
+                model.subscribe()
    
     def unsubscribe(self, request, queryset):
-        for model in queryset:
-            model.unsubscribe()
+        with priority(BULK):
+            for model in queryset:
+                model.unsubscribe()
 
 admin.site.register(UserSubscription, UserSubscriptionAdmin)
 admin.site.register(PendingUserSubscription)
+
+class SyncCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('run_id', 'mode', 'started', 'updated', 'processed', 
+                    'errors', 'finished', 'stopped',)
+    list_filter = ('mode', 'finished', 'stopped',)
+
+admin.site.register(SyncCheckpoint, SyncCheckpointAdmin)
+
+class InterestGroupingAdmin(admin.ModelAdmin):
+    list_display = ('name', 'list_id', 'grouping_id', 'form_field', 'updated',)
+    list_filter = ('list_id',)
+
+admin.site.register(InterestGrouping, InterestGroupingAdmin)
+
+class MemberActivityAdmin(admin.ModelAdmin):
+    list_display = ('user', 'list_id', 'action', 'timestamp', 'campaign_id',)
+    list_filter = ('action', 'list_id',)
+    raw_id_fields = ('user',)
+    date_hierarchy = 'timestamp'
+
+admin.site.register(MemberActivity, MemberActivityAdmin)
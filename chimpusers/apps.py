@@ -0,0 +1,13 @@
+try:
+    from django.apps import AppConfig
+except ImportError: # Django < 1.7 validates the settings on first use instead
+    AppConfig = object
+
+class ChimpUsersConfig(AppConfig):
+    name = 'chimpusers'
+    verbose_name = 'MailChimp Users'
+    
+    def ready(self):
+        """ Validate the MailChimp configuration settings once at startup. """
+        from chimpusers.utils import get_config
+        get_config()
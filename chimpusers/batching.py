@@ -0,0 +1,200 @@
+import threading
+from chimpusers.utils import (get_client, raise_if_error,
+                              get_error_emails, chunks)
+
+_local = threading.local()
+
+def get_current_batch():
+    """ Get the active OperationBatch of the current thread, or None. """
+    return getattr(_local, 'batch', None)
+
+# listBatchSubscribe only accepts these options; subscriptions with any other
+# option are sent individually.
+BATCH_SUBSCRIBE_OPTIONS = ('double_optin', 'update_existing',
+                           'replace_interests', 'email_type')
+BATCH_UNSUBSCRIBE_OPTIONS = ('delete_member', 'send_goodbye', 'send_notify')
+
+
+class OperationBatch(object):
+    """
+    Collects the subscribe(), update(), unsubscribe() and sync() calls made on
+    UserSubscription instances while it is active, and makes them all when it
+    is flushed. Redundant operations on the same subscription are combined:
+
+    - an update() after a subscribe() is folded into the subscribe() with
+      update_existing=True
+    - consecutive update() calls are merged into one
+    - an unsubscribe() replaces any earlier subscribe() or update(), and a
+      subscribe() replaces an earlier unsubscribe()
+    - sync() is dropped when the subscription is subscribed or unsubscribed
+      in the same batch, since that sets the status; otherwise it is made at
+      most once, after the other operations, and always saves
+
+    Subscriptions and unsubscriptions are sent per list with
+    listBatchSubscribe and listBatchUnsubscribe, and syncs with the
+    SyncEngine. listUpdateMember has no batch form and is called per member.
+
+    Use as a context manager, which flushes on a clean exit and discards the
+    operations if an exception is raised, or see
+    chimpusers.middleware.OperationBatchMiddleware.
+    """
+    def __init__(self):
+        self._order = []
+        self._operations = {}
+        self._previous = None
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.deactivate()
+        if exc_type is None:
+            self.flush()
+
+    def activate(self):
+        """ Start collecting the operations of the current thread. """
+        self._previous = get_current_batch()
+        _local.batch = self
+
+    def deactivate(self):
+        """ Stop collecting operations. Collected operations are kept. """
+        _local.batch = self._previous
+        self._previous = None
+
+    def add(self, subscription, method, kwargs):
+        """
+        Queue an operation. Called by the UserSubscription methods; returns
+        what they return within a batch.
+        """
+        key = (subscription.list_id, subscription.user_id)
+        if key not in self._operations:
+            self._order.append(key)
+            self._operations[key] = {'subscription': subscription}
+        ops = self._operations[key]
+        ops['subscription'] = subscription
+        kwargs = dict(kwargs)
+
+        if method == 'sync':
+            if 'subscribe' not in ops and 'unsubscribe' not in ops:
+                ops['sync'] = kwargs
+            return None
+        if method in ('subscribe', 'unsubscribe'):
+            ops.pop('sync', None)
+        if method == 'unsubscribe':
+            ops.pop('subscribe', None)
+            ops.pop('update', None)
+            ops['unsubscribe'] = kwargs
+        elif method == 'subscribe':
+            ops.pop('unsubscribe', None)
+            if 'update' in ops:
+                kwargs = self._merge(ops.pop('update'), kwargs)
+            ops['subscribe'] = kwargs
+        elif method == 'update':
+            if 'subscribe' in ops:
+                ops['subscribe'] = self._merge(ops['subscribe'], kwargs)
+                ops['subscribe']['update_existing'] = True
+            elif 'unsubscribe' not in ops:
+                ops['update'] = self._merge(ops.get('update', {}), kwargs)
+        return True
+
+    def __len__(self):
+        return len(self._order)
+
+    def discard(self):
+        """ Forget the collected operations. """
+        self._order = []
+        self._operations = {}
+
+    def flush(self):
+        """
+        Make the collected operations. Errors reported for individual members
+        by the batch calls are returned as a list of dicts; other errors are
+        raised.
+        """
+        if get_current_batch() is self:
+            self.deactivate()
+        operations = [self._operations[key] for key in self._order]
+        self.discard()
+        errors = []
+        subscribes = {}
+        unsubscribes = {}
+        syncs = []
+        for ops in operations:
+            subscription = ops['subscription']
+            if 'subscribe' in ops:
+                kwargs = ops['subscribe']
+                if set(kwargs) - set(BATCH_SUBSCRIBE_OPTIONS + ('merge_vars',)):
+                    subscription.subscribe(**kwargs)
+                else:
+                    options = tuple((name, kwargs[name]) for name in
+                                    BATCH_SUBSCRIBE_OPTIONS if name in kwargs)
+                    subscribes.setdefault((subscription.list_id, options),
+                                          []).append((subscription, kwargs))
+            if 'update' in ops:
+                subscription.update(**ops['update'])
+            if 'unsubscribe' in ops:
+                kwargs = ops['unsubscribe']
+                options = tuple((name, kwargs[name]) for name in
+                                BATCH_UNSUBSCRIBE_OPTIONS if name in kwargs)
+                unsubscribes.setdefault((subscription.list_id, options),
+                                        []).append((subscription, kwargs))
+            if 'sync' in ops:
+                syncs.append(subscription)
+
+        ms = get_client()
+        for (list_id, options), members in subscribes.items():
+            for chunk in chunks(members, 500):
+                batch = []
+                for subscription, kwargs in chunk:
+                    row = dict(kwargs.get('merge_vars', {}))
+                    row['EMAIL'] = subscription.user.email
+                    row['FNAME'] = subscription.user.first_name
+                    row['LNAME'] = subscription.user.last_name
+                    if 'email_type' in kwargs:
+                        row['EMAIL_TYPE'] = kwargs['email_type']
+                    batch.append(row)
+                batch_options = dict((name, value) for name, value in options
+                                     if name != 'email_type')
+                response = ms.listBatchSubscribe(id=list_id, batch=batch,
+                                                 **batch_options)
+                raise_if_error(response)
+                errors.extend(response.get('errors', []))
+                failed = get_error_emails(response)
+                for subscription, kwargs in chunk:
+                    if subscription.user.email.lower() not in failed:
+                        subscription.set_subscribed(kwargs)
+
+        for (list_id, options), members in unsubscribes.items():
+            for chunk in chunks(members, 500):
+                emails = [subscription.user.email
+                          for subscription, kwargs in chunk]
+                response = ms.listBatchUnsubscribe(id=list_id, emails=emails,
+                                                   **dict(options))
+                raise_if_error(response)
+                errors.extend(response.get('errors', []))
+                failed = get_error_emails(response)
+                for subscription, kwargs in chunk:
+                    if subscription.user.email.lower() not in failed:
+                        subscription.set_unsubscribed(kwargs)
+
+        if syncs:
+            from chimpusers.sync import SyncEngine
+            engine = SyncEngine()
+            try:
+                for subscription, error in engine.sync_batch(syncs):
+                    if error is not None:
+                        raise error
+            finally:
+                engine.close()
+        return errors
+
+    def _merge(self, first, second):
+        """ Combine the keyword arguments of two calls, merging merge_vars. """
+        kwargs = dict(first)
+        kwargs.update(second)
+        if 'merge_vars' in first or 'merge_vars' in second:
+            merge_vars = dict(first.get('merge_vars', {}))
+            merge_vars.update(second.get('merge_vars', {}))
+            kwargs['merge_vars'] = merge_vars
+        return kwargs
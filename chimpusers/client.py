@@ -0,0 +1,243 @@
+"""
+A minimal client for the MailChimp 1.3 API with pluggable transports.
+
+MailChimpClient has the same interface as mailsnake.MailSnake: any API method
+can be called as a method of the client with keyword arguments. The HTTP
+requests are made by a transport, chosen with the MAILCHIMP_TRANSPORT setting
+(a dotted path, default 'chimpusers.client.HTTPTransport') and created with
+the keyword arguments in MAILCHIMP_TRANSPORT_OPTIONS.
+
+RecordingTransport and ReplayTransport can be used to record the responses of
+a real workload and replay them later without a network, eg. for profiling:
+
+    MAILCHIMP_TRANSPORT = 'chimpusers.client.RecordingTransport'
+    MAILCHIMP_TRANSPORT_OPTIONS = {'path': '/tmp/chimpsync.rec.gz'}
+"""
+import atexit
+import gzip
+import hashlib
+import httplib
+import socket
+import threading
+import urllib
+from chimpusers.exceptions import MailChimpTransportError, MailChimpTimeout
+from chimpusers.scheduler import remaining_time
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+API_PATH = '/1.3/?method=%s'
+
+class MailChimpClient(object):
+    """
+    Calls the MailChimp API through a transport. If a scheduler is given (see
+    chimpusers.scheduler) each call waits for its turn in the rate budget.
+
+    Each call times out after 'timeout' seconds, or the number of seconds
+    given for the method in the 'timeouts' dict, or when the deadline of the
+    current thread passes if that is sooner; see chimpusers.scheduler.deadline.
+
+    'calls' counts the calls made by the client, eg. for the report of a run.
+    """
+    def __init__(self, api_key, transport=None, scheduler=None, timeout=None,
+                 timeouts=None):
+        self.api_key = api_key
+        dc = 'us1'
+        if '-' in api_key:
+            dc = api_key.split('-')[1]
+        self.host = '%s.api.mailchimp.com' % dc
+        self.transport = transport or HTTPTransport()
+        self.scheduler = scheduler
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def call(self, method, params=None):
+        """ Call an API method and return the decoded response. """
+        params = dict(params or {})
+        params['apikey'] = self.api_key
+        with self._lock:
+            self.calls += 1
+        if self.scheduler is not None:
+            self.scheduler.acquire()
+        timeout = self.timeouts.get(method, self.timeout)
+        remaining = remaining_time()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            timeout = remaining
+        return self.transport.request(self.host, method, params, timeout)
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def call(*args, **kwargs):
+            params = dict(enumerate(args))
+            params.update(kwargs)
+            return self.call(method, params)
+        return call
+
+
+class Transport(object):
+    """ The interface of the transports. """
+    def request(self, host, method, params, timeout=None):
+        """
+        Make a request for an API method and return the decoded response.
+        Raises MailChimpTransportError if no response is received, or 
+        MailChimpTimeout if it takes longer than 'timeout' seconds.
+        """
+        raise NotImplementedError
+
+
+class HTTPTransport(Transport):
+    """
+    Posts the requests over persistent HTTPS connections, kept open per thread
+    and host so that consecutive calls do not pay for a new TCP and TLS
+    handshake. A request that fails on a reused connection is retried once on
+    a new connection, unless it timed out. A response that is not JSON, or an
+    HTTP error without an API error in its body, raises 
+    MailChimpTransportError. 'timeout' is the default timeout of the socket 
+    operations of a request, in seconds.
+    """
+    def __init__(self, timeout=None, secure=True):
+        self.timeout = timeout
+        self.secure = secure
+        self._local = threading.local()
+
+    def request(self, host, method, params, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        body = urllib.quote(json.dumps(params))
+        headers = {'Content-Type': 'application/json'}
+        for attempt in (1, 2):
+            connection, reused = self._get_connection(host)
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request('POST', API_PATH % method, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except socket.timeout:
+                self._close(host)
+                raise MailChimpTimeout("No response to %s within %s seconds" 
+                                       % (method, timeout))
+            except (httplib.HTTPException, socket.error) as e:
+                self._close(host)
+                if not reused or attempt == 2:
+                    raise MailChimpTransportError(str(e))
+        if response.status != 200:
+            self._close(host)
+        try:
+            decoded = json.loads(data)
+        except ValueError:
+            raise MailChimpTransportError("Invalid response to %s: HTTP %d %s"
+                                % (method, response.status, response.reason))
+        if response.status != 200 and not (isinstance(decoded, dict) and
+                                            'code' in decoded):
+            raise MailChimpTransportError("HTTP %d %s from %s" % (
+                                response.status, response.reason, method))
+        return decoded
+
+    def _get_connection(self, host):
+        """ Return the connection to 'host' and whether it was used before. """
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        if host in connections:
+            return connections[host], True
+        if self.secure:
+            connection = httplib.HTTPSConnection(host)
+        else:
+            connection = httplib.HTTPConnection(host)
+        connections[host] = connection
+        return connection, False
+
+    def _close(self, host):
+        connections = getattr(self._local, 'connections', {})
+        connection = connections.pop(host, None)
+        if connection is not None:
+            connection.close()
+
+
+def request_key(method, params):
+    """
+    A key identifying a request by its method and parameters, without the API
+    key, for RecordingTransport and ReplayTransport.
+    """
+    params = dict((str(name), value) for name, value in params.items()
+                  if name != 'apikey')
+    data = json.dumps([method, params], sort_keys=True)
+    return hashlib.sha1(data).hexdigest()[:20]
+
+
+class RecordingTransport(Transport):
+    """
+    Makes the requests with another transport (HTTPTransport by default) and
+    appends the responses to a gzipped file with one compact JSON record per
+    line: [method, request key, response]. Records are written in blocks of
+    'buffer_size' and when the process exits.
+    """
+    def __init__(self, path, transport=None, buffer_size=100, **kwargs):
+        self.path = path
+        self.transport = transport or HTTPTransport(**kwargs)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def request(self, host, method, params, timeout=None):
+        response = self.transport.request(host, method, params, timeout)
+        record = json.dumps([method, request_key(method, params), response],
+                            separators=(',', ':'))
+        with self._lock:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.buffer_size
+        if full:
+            self.flush()
+        return response
+
+    def flush(self):
+        """ Append the buffered records to the file. """
+        with self._lock:
+            if not self._buffer:
+                return
+            f = gzip.open(self.path, 'ab')
+            try:
+                f.write('\n'.join(self._buffer) + '\n')
+            finally:
+                f.close()
+            self._buffer = []
+
+
+class ReplayTransport(Transport):
+    """
+    Answers the requests with the responses stored by RecordingTransport,
+    without a network. Responses to identical requests are returned in the
+    order they were recorded; once they are used up the last one is repeated.
+    Raises MailChimpTransportError for a request that was not recorded.
+    """
+    def __init__(self, path):
+        self._responses = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        f = gzip.open(path, 'rb')
+        try:
+            for line in f:
+                method, key, response = json.loads(line)
+                self._responses.setdefault(key, []).append(response)
+        finally:
+            f.close()
+
+    def request(self, host, method, params, timeout=None):
+        key = request_key(method, params)
+        try:
+            responses = self._responses[key]
+        except KeyError:
+            raise MailChimpTransportError("No recorded response for %s" %
+                                          method)
+        with self._lock:
+            position = self._positions.get(key, 0)
+            self._positions[key] = min(position + 1, len(responses) - 1)
+        return responses[position]
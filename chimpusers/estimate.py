@@ -0,0 +1,123 @@
+import math
+import random
+from django.db.models import Count, Min, Max
+from chimpusers.models import UserSubscription
+
+def wilson_interval(mismatched, sampled, z=1.96):
+    """
+    The Wilson score interval of a proportion, by default with 95%
+    confidence. Returns a (low, high) tuple.
+    """
+    if not sampled:
+        return 0.0, 1.0
+    p = float(mismatched) / sampled
+    denominator = 1 + z * z / sampled
+    center = (p + z * z / (2 * sampled)) / denominator
+    half = z * math.sqrt(p * (1 - p) / sampled +
+                         z * z / (4 * sampled * sampled)) / denominator
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+class DriftEstimate(object):
+    """
+    Estimates how many local UserSubscription statuses differ from MailChimp
+    by checking a random sample instead of every row.
+
+    The subscriptions are stratified by local status and 'sample_size' rows
+    are split between the strata in proportion to their size, with at least
+    'min_stratum' rows from each (or all of a small stratum). Rows are
+    sampled by probing random primary keys, so no stratum is read in full,
+    and checked with the batched listMemberInfo calls of a SyncEngine;
+    nothing is saved.
+
+    After run() 'strata' maps each status to a dict with the 'population',
+    'sampled' and 'mismatched' counts, the estimated mismatch 'rate' and its
+    95% 'interval'. 'rate' and 'interval' are also available for all the
+    subscriptions, weighted by stratum size. 'errors' lists the exceptions
+    of failed calls; their rows are not counted.
+    """
+    def __init__(self, engine, lists=None, sample_size=1000, min_stratum=30):
+        self.engine = engine
+        self.lists = lists
+        self.sample_size = sample_size
+        self.min_stratum = min_stratum
+        self.strata = {}
+        self.rate = None
+        self.interval = None
+        self.errors = []
+
+    def run(self):
+        subscriptions = self.engine.get_subscriptions(self.lists).order_by()
+        populations = dict(subscriptions.values_list('status')
+                                        .annotate(count=Count('pk')))
+        total = sum(populations.values())
+        for status, population in populations.items():
+            size = max(self.min_stratum,
+                       int(round(float(self.sample_size) * population / total)))
+            sample = self.sample(subscriptions.filter(status=status),
+                                 min(size, population))
+            mismatched = sampled = 0
+            for subscription, data, error in self.engine.fetch_batch(sample):
+                if error is not None:
+                    self.errors.append(error)
+                    continue
+                sampled += 1
+                remote = UserSubscription.status_from_member_info(data)
+                if remote != subscription.status:
+                    mismatched += 1
+            rate = float(mismatched) / sampled if sampled else 0.0
+            if sampled == population:
+                interval = (rate, rate)
+            else:
+                interval = wilson_interval(mismatched, sampled)
+            self.strata[status] = {'population': population,
+                                   'sampled': sampled,
+                                   'mismatched': mismatched,
+                                   'rate': rate, 'interval': interval}
+        self.rate, self.interval = self._combine(total)
+        return self
+
+    def sample(self, queryset, size):
+        """
+        Choose up to 'size' distinct rows of 'queryset' at random by probing
+        for the first row at or after random primary keys. Rows after gaps in
+        the keys are slightly more likely to be chosen.
+        """
+        bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+        if bounds['low'] is None:
+            return []
+        chosen = {}
+        attempts = 0
+        while len(chosen) < size and attempts < size * 4:
+            attempts += 1
+            pk = random.randint(bounds['low'], bounds['high'])
+            try:
+                row = queryset.filter(pk__gte=pk).order_by('pk')[0]
+            except IndexError:
+                continue
+            chosen[row.pk] = row
+        if len(chosen) < size:
+            # a sparse or skewed stratum, top up in key order
+            for row in queryset.exclude(pk__in=chosen.keys()) \
+                               .order_by('pk')[:size - len(chosen)]:
+                chosen[row.pk] = row
+        return chosen.values()
+
+    def _combine(self, total):
+        """
+        The overall rate and a normal approximation of its interval,
+        weighting the strata by population.
+        """
+        if not total:
+            return 0.0, (0.0, 0.0)
+        rate = variance = 0.0
+        for stratum in self.strata.values():
+            weight = float(stratum['population']) / total
+            rate += weight * stratum['rate']
+            if stratum['sampled'] and \
+               stratum['sampled'] < stratum['population']:
+                # the Wilson interval half width is the stratum's error margin
+                low, high = stratum['interval']
+                variance += (weight * (high - low) / 2 / 1.96) ** 2
+        margin = 1.96 * math.sqrt(variance)
+        return rate, (max(0.0, rate - margin), min(1.0, rate + margin))
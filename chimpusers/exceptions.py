@@ -17,5 +17,14 @@ class MailChimpEmailNotFound(MailChimpBaseException):
 
 class MailChimpEmailUnsubscribed(MailChimpBaseException):
     pass
-    
 
+class MailChimpTransportError(MailChimpBaseException):
+    """ A request could not be made or answered by the transport. """
+    pass
+
+class MailChimpTimeout(MailChimpTransportError):
+    """ 
+    A call did not complete within its timeout or the deadline of the 
+    operation. 
+    """
+    pass
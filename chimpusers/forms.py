@@ -1,10 +1,12 @@
 import logging
+import time
 from datetime import datetime
-from mailsnake import MailSnake
-from chimpusers.utils import get_list_id, raise_if_error
+from chimpusers.utils import (get_list_id, get_client, 
+                              raise_if_error, call_async, gather)
 from chimpusers.exceptions import *
+from chimpusers.groups import GroupingIndex, serialize_groups
+from chimpusers.scheduler import deadline, get_deadline
 from django import forms
-from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.utils.datastructures import SortedDict
@@ -32,9 +34,9 @@ class _GroupsForm(forms.BaseForm):
         if self._grouping['form_field'] == 'checkboxes':
             self.selected_groups = self._get_checkboxes_groups()
         else:
-            self.selected_groups = [self._get_choices_group()]
-        escaped = [group.replace(',','\,') for group in self.selected_groups]
-        group_string = ",".join(escaped)
+            group = self._get_choices_group()
+            self.selected_groups = [group] if group else []
+        group_string = serialize_groups(self.selected_groups)
         self.merge_var = {'name':self._grouping['name'], 'groups':group_string} 
         
         return super(_GroupsForm, self).clean()
@@ -43,20 +45,12 @@ class _GroupsForm(forms.BaseForm):
         """ Return the selected group as a string. """
         if 'mailchimp_group' in self.cleaned_data:
             selected_value = self.cleaned_data['mailchimp_group']
-            for value, choice in self.fields['mailchimp_group'].choices:
-                if value == selected_value:
-                    return choice
+            return self._index.by_bit.get(selected_value)
     
     def _get_checkboxes_groups(self):
         """ Return list of checked groups. """
-        groups = []
-        for key, value in self.cleaned_data.items():
-            if value:
-                #logging.debug("%s = %s" % (key, value))
-                for field in self:
-                    if field.name == key:
-                        groups.append(field.label)
-        return groups
+        checked = [key for key, value in self.cleaned_data.items() if value]
+        return self._index.names_for_keys(checked)
         
 def groups_form_factory(email=None, grouping_name=None, list_id=None):
     """
@@ -68,18 +62,66 @@ def groups_form_factory(email=None, grouping_name=None, list_id=None):
                     then the first grouping will be used.
     list_id         The MailChimp list ID. If not provided, the value defined in 
                     the config settings will be used.
+    
+    The API calls must complete within MAILCHIMP_FORM_DEADLINE seconds 
+    (default 0.5) in total, otherwise MailChimpTimeout is raised.
+    """
+    with deadline(getattr(settings, 'MAILCHIMP_FORM_DEADLINE', 0.5)):
+        return groups_form_factory_async(email, grouping_name, list_id).get()
+
+def groups_form_factory_async(email=None, grouping_name=None, list_id=None):
     """
-    if not hasattr(settings, 'MAILCHIMP_API_KEY'):
-        raise ImproperlyConfigured(_("You need to specify MAILCHIMP_API_KEY" \
-                                     "in your Django settings file."))                               
-    ms = MailSnake(settings.MAILCHIMP_API_KEY)
+    Like groups_form_factory(), but returns immediately. The grouping and
+    member lookups are made concurrently in the shared thread pool. Call get()
+    on the returned object to wait for them and get the form class.
+    """
+    ms = get_client()
     
     if not list_id:
         list_id = get_list_id()
-        
+    
+    groupings = call_async(ms.listInterestGroupings, id=list_id)
+    if email:
+        member = call_async(ms.listMemberInfo, id=list_id, 
+                            email_address=[email])
+    else:
+        member = None
+    return _PendingGroupsForm(groupings, member, grouping_name)
+
+class _PendingGroupsForm(object):
+    """ The result of groups_form_factory_async(). """
+    def __init__(self, groupings, member, grouping_name):
+        self._groupings = groupings
+        self._member = member
+        self._grouping_name = grouping_name
+        self._deadline = get_deadline()
+    
+    def get(self, timeout=None):
+        """ 
+        Wait for the API calls and return the form class. Raises the same 
+        exceptions as groups_form_factory(), and MailChimpTimeout if the calls
+        do not complete within 'timeout' seconds or by the deadline in effect
+        when groups_form_factory_async() was called.
+        """
+        if self._deadline is not None:
+            remaining = max(0, self._deadline - time.time())
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        if self._member:
+            response, member = gather(self._groupings, self._member, 
+                                      timeout=timeout)
+        else:
+            response, = gather(self._groupings, timeout=timeout)
+            member = None
+        return _build_groups_form(response, member, self._grouping_name)
+
+def _build_groups_form(response, member, grouping_name):
+    """
+    Create the form class from the listInterestGroupings response and the
+    optional listMemberInfo response.
+    """
     # get all groupings for the list
     grouping = None
-    response = ms.listInterestGroupings(id=list_id)
     raise_if_error(response)
     
     # get the correct grouping
@@ -94,39 +136,31 @@ def groups_form_factory(email=None, grouping_name=None, list_id=None):
         errmsg = _("Grouping not found: '%s'") % grouping_name
         raise MailChimpGroupingNotFound(errmsg)
     
-
-    if email:
+    index = GroupingIndex(grouping)
+    selected = set()
+    if member:
         # get the user's group subscription to set initial field values
-        response = ms.listMemberInfo(id=list_id, email_address=[email])
-        if not response['success']:
+        if not member['success']:
             raise MailChimpEmailNotFound
-        user_groupings = response['data'][0]['merges']['GROUPINGS']
+        user_groupings = member['data'][0]['merges']['GROUPINGS']
         for try_grouping in user_groupings:
             if try_grouping['name'] == grouping_name:
-                user_grouping = try_grouping   
+                selected = index.parse(try_grouping['groups'])
     
     # create the appropriate type of fields
     if grouping['form_field'] == 'checkboxes':
         fields = SortedDict()
-        for i, group in enumerate(grouping['groups']):
-            key = 'mailchimp_group_'+group['bit']
-            if email:
-                initial=bool(user_grouping['groups'].find(group['name'])+1)
-            else:
-                initial=False
-            fields.insert(i, key, forms.BooleanField(label=group['name'], 
-                                                     required=False, 
-                                                     initial=initial))
+        for i, (bit, name) in enumerate(index.groups):
+            fields.insert(i, index.field_key(bit), 
+                          forms.BooleanField(label=name, required=False, 
+                                             initial=name in selected))
     else: # radio or select
         fields = {}
-        CHOICES = tuple((group['bit'], group['name']) for group in grouping['groups'])
-        for group in grouping['groups']:
-            initial=None
-            if email:
-                if bool(user_grouping['groups'].find(group['name'])+1):
-                    initial = group['bit']
-            else:
-                initial = None
+        CHOICES = tuple(index.groups)
+        initial = None
+        for bit, name in index.groups:
+            if name in selected:
+                initial = bit
         if grouping['form_field'] == 'radio': 
             widget = RadioSelect
         else:
@@ -138,6 +172,7 @@ def groups_form_factory(email=None, grouping_name=None, list_id=None):
     
     form = type('GroupsForm', (_GroupsForm,), {'base_fields': fields})
     form._grouping = grouping
+    form._index = index
 
     return form
 
@@ -0,0 +1,79 @@
+FIELD_PREFIX = 'mailchimp_group_'
+
+def parse_groups(value):
+    """
+    Split a group string as used by MailChimp in the GROUPINGS merge var, eg.
+    'Option One, Option\, Two', into a list of group names. Commas escaped
+    with a backslash are part of the name.
+    """
+    names = []
+    current = []
+    chars = iter(value or '')
+    for char in chars:
+        if char == '\\':
+            following = next(chars, '')
+            if following == ',':
+                current.append(',')
+            else:
+                current.append(char + following)
+        elif char == ',':
+            names.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    names.append(''.join(current).strip())
+    return [name for name in names if name]
+
+def serialize_groups(names):
+    """ The reverse of parse_groups(). """
+    return ','.join(name.replace(',', '\\,') for name in names)
+
+
+class GroupingIndex(object):
+    """
+    Lookup tables between the names, bits and form field keys of the groups
+    in one grouping of a listInterestGroupings response.
+    """
+    def __init__(self, grouping):
+        self.grouping = grouping
+        self.id = grouping.get('id')
+        self.name = grouping['name']
+        self.form_field = grouping['form_field']
+        self.groups = [(group['bit'], group['name'])
+                       for group in grouping['groups']]
+        self.by_name = dict((name, bit) for bit, name in self.groups)
+        self.by_bit = dict(self.groups)
+        self.by_key = dict((self.field_key(bit), name)
+                           for bit, name in self.groups)
+
+    def field_key(self, bit):
+        """ The form field name used for a group in a checkboxes grouping. """
+        return FIELD_PREFIX + bit
+
+    def parse(self, value):
+        """
+        Get the set of names of the known groups in a group string.
+        """
+        return set(name for name in parse_groups(value)
+                   if name in self.by_name)
+
+    def names_for_keys(self, keys):
+        """
+        Get the names of the groups for the given form field keys, in the
+        order of the grouping.
+        """
+        keys = set(keys)
+        return [name for bit, name in self.groups
+                if self.field_key(bit) in keys]
+
+    def mask(self, names):
+        """ Get the bitmask of the groups with the given names. """
+        mask = 0
+        for name in names:
+            if name in self.by_name:
+                mask |= int(self.by_name[name])
+        return mask
+
+    def names_for_mask(self, mask):
+        """ Get the names of the groups in a bitmask, in grouping order. """
+        return [name for bit, name in self.groups if mask & int(bit)]
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from chimpusers.scheduler import priority, BULK
+
+class BulkCommand(BaseCommand):
+    """
+    A management command whose API calls are made with the BULK priority,
+    leaving the rate budget to interactive calls first. See
+    chimpusers.scheduler.
+    """
+    def execute(self, *args, **options):
+        with priority(BULK):
+            return super(BulkCommand, self).execute(*args, **options)
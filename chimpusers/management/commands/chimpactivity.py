@@ -0,0 +1,34 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from chimpusers.management.base import BulkCommand
+from chimpusers.models import MemberActivity
+
+class Command(BulkCommand):
+    help = 'Stores the new activity (opens, clicks, etc.) of every member ' \
+           'of a list from the MailChimp API.'
+    option_list = BaseCommand.option_list + (
+        make_option('--list', dest='list_id', default=None,
+                    help='MailChimp list ID. Defaults to MAILCHIMP_LIST_ID.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500,
+                    help='Number of members fetched between inserts.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be a positive integer.")
+        verbosity = int(options.get('verbosity', 1))
+
+        def progress(created, errors):
+            if verbosity > 1:
+                self.stdout.write("%d activity rows stored, %d errors\n"
+                                  % (created, len(errors)))
+
+        created, errors = MemberActivity.objects.ingest(
+                                list_id=options['list_id'],
+                                chunk_size=options['chunk_size'],
+                                progress=progress)
+        for error in errors:
+            self.stderr.write("%s\n" % error)
+        self.stdout.write("%d activity rows stored, %d errors\n"
+                          % (created, len(errors)))
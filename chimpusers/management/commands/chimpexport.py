@@ -0,0 +1,115 @@
+import csv
+import gzip
+from datetime import datetime
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from chimpusers.models import UserSubscription
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+COLUMNS = ('email', 'list_id', 'status', 'optin_time', 'optin_ip')
+
+def parse_status(value):
+    """ Get a UserSubscription status from its number or name. """
+    for status, label in UserSubscription.CHOICES:
+        if value in (str(status), label.lower().replace(' ', '_')):
+            return status
+    raise CommandError("Unknown status: '%s'" % value)
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError("Dates must be in the format YYYY-MM-DD.")
+
+def encode_csv(value):
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+def encode_json(row):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in row]
+    return json.dumps(dict(zip(COLUMNS, values)))
+
+class Command(BaseCommand):
+    help = 'Streams every UserSubscription with the user\'s email address ' \
+           'as CSV or NDJSON.'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+                    choices=('csv', 'ndjson'),
+                    help='Output format: csv (default) or ndjson.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write to this file instead of stdout. The file is '
+                         'gzipped if the name ends with .gz.'),
+        make_option('--status', action='append', dest='statuses', default=[],
+                    help='Only export this status, eg. subscribed or 3. May '
+                         'be given more than once.'),
+        make_option('--list', dest='list_id', default=None,
+                    help='Only export this MailChimp list ID.'),
+        make_option('--since', dest='since', default=None,
+                    help='Only export opt-ins on or after this date '
+                         '(YYYY-MM-DD).'),
+        make_option('--until', dest='until', default=None,
+                    help='Only export opt-ins before this date (YYYY-MM-DD).'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=5000,
+                    help='Number of rows read per query.'),
+    )
+
+    def handle(self, *args, **options):
+        queryset = UserSubscription.objects.all()
+        if options['statuses']:
+            statuses = [parse_status(s) for s in options['statuses']]
+            queryset = queryset.filter(status__in=statuses)
+        if options['list_id']:
+            queryset = queryset.filter(list_id=options['list_id'])
+        if options['since']:
+            queryset = queryset.filter(
+                            optin_time__gte=parse_date(options['since']))
+        if options['until']:
+            queryset = queryset.filter(
+                            optin_time__lt=parse_date(options['until']))
+
+        output = options['output']
+        if not output:
+            stream = self.stdout
+        elif output.endswith('.gz'):
+            stream = gzip.open(output, 'wb')
+        else:
+            stream = open(output, 'wb')
+
+        try:
+            if options['format'] == 'csv':
+                writer = csv.writer(stream)
+                writer.writerow(COLUMNS)
+                write = lambda row: writer.writerow([encode_csv(v) for v in row])
+            else:
+                write = lambda row: stream.write(encode_json(row) + "\n")
+            labels = dict(UserSubscription.CHOICES)
+            for row in self.iter_rows(queryset, options['chunk_size']):
+                write((row[0], row[1], labels[row[2]]) + row[3:])
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+
+    def iter_rows(self, queryset, chunk_size):
+        """
+        Yields the exported columns of each row. Rows are read in chunks
+        ordered by primary key, each chunk starting after the last key of the
+        previous one, so that memory use and query cost stay constant no
+        matter how many rows there are.
+        """
+        queryset = queryset.order_by('pk').values_list('pk', 'user__email',
+                                                       'list_id', 'status',
+                                                       'optin_time',
+                                                       'optin_ip')
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            last_pk = rows[-1][0]
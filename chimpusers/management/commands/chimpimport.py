@@ -0,0 +1,139 @@
+import csv
+import os
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from chimpusers.models import UserSubscription
+from chimpusers.stats import refresh_counts
+from chimpusers.utils import (get_list_id, email_hash, chunks, atomic,
+                              parse_timestamp)
+
+class Command(BaseCommand):
+    args = '<export.csv export.csv ...>'
+    help = 'Seeds UserSubscription rows from MailChimp list export files ' \
+           'without calling the API.'
+    option_list = BaseCommand.option_list + (
+        make_option('--status', dest='status', default=None,
+                    choices=UserSubscription.API_STATUSES.keys(),
+                    help='Status of the members in the files. By default '
+                         'it is taken from the file name, eg. '
+                         'unsubscribed_members_export_1a2b3c.csv.'),
+        make_option('--list', dest='list_id', default=None,
+                    help='MailChimp list ID. Defaults to MAILCHIMP_LIST_ID.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=1000,
+                    help='Number of rows written per transaction.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Provide at least one export file.")
+        list_id = options['list_id'] or get_list_id()
+
+        self.stdout.write("Indexing users...\n")
+        users = {}
+        for email, pk in User.objects.values_list('email', 'pk').iterator():
+            if email:
+                users[email_hash(email)] = pk
+        subscriptions = dict(UserSubscription.objects.for_list(list_id)
+                                 .values_list('user_id', 'pk').iterator())
+
+        for path in args:
+            status = options['status'] or self.status_from_path(path)
+            self.stdout.write("Importing %s as %s\n" % (path, status))
+            with open(path, 'rb') as f:
+                rows = self.iter_rows(f, users,
+                                      UserSubscription.API_STATUSES[status])
+                self.import_rows(rows, subscriptions, list_id,
+                                 options['chunk_size'])
+        refresh_counts(list_id)
+
+    def status_from_path(self, path):
+        name = os.path.basename(path)
+        for status in UserSubscription.API_STATUSES:
+            if name.startswith(status + '_'):
+                return status
+        raise CommandError("Cannot tell the status of the members in '%s', "
+                           "use --status." % path)
+
+    def iter_rows(self, f, users, status):
+        """
+        Parse an export file one row at a time. Yields a (user pk, fields) 
+        tuple for each row that matches a user, where 'fields' is a dict of 
+        the status and the optin time and ip if the row has them. Rows with a
+        malformed OPTIN_TIME are skipped.
+        """
+        reader = csv.reader(f)
+        header = [column.strip().upper() for column in reader.next()]
+        try:
+            email_col = header.index('EMAIL ADDRESS')
+        except ValueError:
+            try:
+                email_col = header.index('EMAIL')
+            except ValueError:
+                raise CommandError("No email address column in the file.")
+        time_col = ip_col = None
+        if 'OPTIN_TIME' in header:
+            time_col = header.index('OPTIN_TIME')
+        if 'OPTIN_IP' in header:
+            ip_col = header.index('OPTIN_IP')
+
+        self.read = self.matched = self.skipped = 0
+        for row in reader:
+            if len(row) <= email_col:
+                continue
+            self.read += 1
+            pk = users.get(email_hash(row[email_col].decode('utf-8')))
+            if pk is None:
+                continue
+            fields = {'status': status}
+            if time_col is not None and row[time_col]:
+                try:
+                    fields['optin_time'] = parse_timestamp(row[time_col])
+                except ValueError:
+                    self.skipped += 1
+                    self.stderr.write("Skipped line %d, invalid OPTIN_TIME "
+                                      "'%s'\n" % (reader.line_num, 
+                                                   row[time_col]))
+                    continue
+            if ip_col is not None and row[ip_col]:
+                fields['optin_ip'] = row[ip_col]
+            self.matched += 1
+            yield pk, fields
+
+    def import_rows(self, rows, subscriptions, list_id, chunk_size):
+        """
+        Write the rows in chunks, one transaction per chunk. Rows with the same
+        values are updated with a single query, leaving the fields a row has 
+        no value for unchanged, and rows of users without a subscription to 
+        the list are created with bulk_create().
+        """
+        updated = created = 0
+        for chunk in chunks(rows, chunk_size):
+            updates = {}
+            new = {}
+            for pk, fields in chunk:
+                if pk in subscriptions:
+                    values = tuple(sorted(fields.items()))
+                    updates.setdefault(values, []).append(subscriptions[pk])
+                else:
+                    new[pk] = UserSubscription(user_id=pk, list_id=list_id,
+                                               **fields)
+            with atomic():
+                for values, pks in updates.items():
+                    UserSubscription.objects.filter(pk__in=pks).update(
+                        **dict(values))
+                    updated += len(pks)
+                if new:
+                    UserSubscription.objects.bulk_create(new.values())
+                    created += len(new)
+            if new:
+                subscriptions.update(UserSubscription.objects.for_list(list_id)
+                                     .filter(user__in=new.keys())
+                                     .values_list('user_id', 'pk'))
+            UserSubscription.objects.refresh_cached_statuses(
+                UserSubscription.objects.for_list(list_id).filter(
+                    user__in=[row[0] for row in chunk]))
+            self.stdout.write("%d rows read, %d matched, %d skipped, "
+                              "%d updated, %d created\n" % (self.read, 
+                              self.matched, self.skipped, updated, created))
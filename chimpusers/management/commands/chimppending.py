@@ -0,0 +1,41 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from chimpusers.management.base import BulkCommand
+from chimpusers.models import PendingUserSubscription
+
+class Command(BulkCommand):
+    help = 'Subscribes the users of every PendingUserSubscription in batches ' \
+           'and deletes the pending rows.'
+    option_list = BaseCommand.option_list + (
+        make_option('--single-optin', action='store_false', 
+                    dest='double_optin', default=True,
+                    help='Subscribe without sending the opt-in confirmation '
+                         'email.'),
+        make_option('--update-existing', action='store_true', 
+                    dest='update_existing', default=False,
+                    help='Update the members that are already subscribed.'),
+        make_option('--list', dest='list_id', default=None,
+                    help='MailChimp list ID. Defaults to MAILCHIMP_LIST_ID.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', 
+                    default=500,
+                    help='Number of users per listBatchSubscribe call.'),
+    )
+    
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be a positive integer.")
+        total = PendingUserSubscription.objects.count()
+        self.stdout.write("Subscribing %d pending users\n" % total)
+        
+        def progress(subscribed, errors):
+            self.stdout.write("%d subscribed, %d errors\n" 
+                              % (subscribed, len(errors)))
+        
+        subscribed, errors = PendingUserSubscription.objects.flush(
+                                chunk_size=options['chunk_size'],
+                                list_id=options['list_id'],
+                                progress=progress,
+                                double_optin=options['double_optin'],
+                                update_existing=options['update_existing'])
+        for error in errors:
+            self.stderr.write("%s\n" % error.get('message', error))
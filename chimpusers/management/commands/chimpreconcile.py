@@ -0,0 +1,60 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from chimpusers.management.base import BulkCommand
+from chimpusers.models import UserSubscription
+from chimpusers.reconcile import Reconciliation
+from chimpusers.stats import refresh_counts
+
+class Command(BulkCommand):
+    help = 'Reports the differences between the local subscriptions and the ' \
+           'MailChimp list, and optionally applies them.'
+    option_list = BaseCommand.option_list + (
+        make_option('--apply', action='store_true', dest='apply',
+                    default=False,
+                    help='Pull mismatched statuses and push missing '
+                         'subscribers to MailChimp.'),
+        make_option('--prune', action='store_true', dest='prune',
+                    default=False,
+                    help='With --apply, also unsubscribe list members that '
+                         'have no active user.'),
+        make_option('--single-optin', action='store_false', 
+                    dest='double_optin', default=True,
+                    help='With --apply, subscribe the missing subscribers '
+                         'without sending them a confirmation email. Only '
+                         'use this if you have a record of their consent.'),
+        make_option('--list', dest='list_id', default=None,
+                    help='MailChimp list ID. Defaults to MAILCHIMP_LIST_ID.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['prune'] and not options['apply']:
+            raise CommandError("--prune can only be used with --apply.")
+        if not options['double_optin'] and not options['apply']:
+            raise CommandError("--single-optin can only be used with --apply.")
+        verbosity = int(options.get('verbosity', 1))
+        reconciliation = Reconciliation(list_id=options['list_id']).run()
+
+        if verbosity > 1:
+            labels = dict(UserSubscription.CHOICES)
+            for email in reconciliation.missing_emails():
+                self.stdout.write("+ %s\n" % email)
+            for email in reconciliation.orphans:
+                self.stdout.write("- %s\n" % email)
+            for pk, email, local, remote in reconciliation.mismatched:
+                self.stdout.write("~ %s\t\t%s -> %s\n" % (email, labels[local],
+                                                         labels[remote]))
+        self.stdout.write("Missing from MailChimp: %d\n"
+                          % len(reconciliation.missing))
+        self.stdout.write("Members without a user: %d\n"
+                          % len(reconciliation.orphans))
+        self.stdout.write("Status mismatches:      %d\n"
+                          % len(reconciliation.mismatched))
+
+        if options['apply']:
+            calls = reconciliation.apply(prune=options['prune'],
+                                         double_optin=options['double_optin'])
+            self.stdout.write("Applied with %d API calls, %d errors\n"
+                              % (calls, len(reconciliation.errors)))
+            refresh_counts(reconciliation.list_id)
+            for error in reconciliation.errors:
+                self.stderr.write("%s\n" % error.get('message', error))
@@ -1,18 +1,299 @@
-from mailsnake import MailSnake
+import time
+import uuid
+from datetime import timedelta
+from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
-from django.contrib.auth.models import User
-from chimpusers.models import UserSubscription
+from chimpusers.management.base import BulkCommand
+from chimpusers.models import UserSubscription, SyncCheckpoint
+from chimpusers.estimate import DriftEstimate
+from chimpusers.stats import refresh_counts, get_list_ids
+from chimpusers.sync import SyncEngine
+from chimpusers.utils import get_list_id, chunks
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
 
-# TODO: command line args and verbosity
+class Command(BulkCommand):
+    help = ('Syncs every user\'s subscription status with the MailChimp API. '
+            'Use -v 0 to only show errors, -v 2 to also list the changed '
+            'statuses, or -v 3 to list every subscription.')
+    progress_interval = 10
+    option_list = BaseCommand.option_list + (
+        make_option('--resume', action='store_true', dest='resume',
+                    default=False,
+                    help='Continue the most recent unfinished run from its '
+                         'last checkpoint.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=100,
+                    help='Number of subscriptions to sync between '
+                         'checkpoints.'),
+        make_option('--list', action='append', dest='lists', default=[],
+                    help='Only sync this MailChimp list ID. May be given more '
+                         'than once. Defaults to every list.'),
+        make_option('--database', dest='database', default=None,
+                    help='Database alias that changed subscriptions and '
+                         'checkpoints are written to. Defaults to the alias '
+                         'chosen by the database routers.'),
+        make_option('--read-database', dest='read_database', default=None,
+                    help='Database alias that subscriptions are read from, '
+                         'eg. a replica. Defaults to --database. Runs that '
+                         'create subscriptions read from --database.'),
+        make_option('--statement-timeout', type='int', 
+                    dest='statement_timeout', default=None,
+                    help='Statement timeout in milliseconds for the sync\'s '
+                         'database connections (PostgreSQL only).'),
+        make_option('--stale', type='int', dest='stale', default=None,
+                    help='Only sync this many of the subscriptions that most '
+                         'need it: pending, never synced, often changed and '
+                         'least recently synced.'),
+        make_option('--time-budget', type='float', dest='time_budget',
+                    default=None,
+                    help='Stop starting new batches after this many seconds.'),
+        make_option('--estimate', action='store_true', dest='estimate',
+                    default=False,
+                    help='Only estimate the share of statuses that differ '
+                         'from MailChimp by checking a random sample.'),
+        make_option('--sample-size', type='int', dest='sample_size',
+                    default=1000,
+                    help='Number of subscriptions checked by --estimate.'),
+        make_option('--report', action='store_true', dest='report',
+                    default=False,
+                    help='Store a JSON report of the run on its checkpoint.'),
+    )
 
-class Command(BaseCommand):
-    help = 'Syncs every user\'s subscription status with the MailChimp API'
-    
     def handle(self, *args, **options):
-        users = User.objects.filter(is_active=True)
-        for user in users:
-            subscription, created = UserSubscription.objects.get_or_create(user=user)
-            subscription.sync(True)
-            self.stdout.write("%s\t\t%s\n" % (user.email, 
-                                            subscription.get_status_display()))
-        
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("--batch-size must be a positive integer.")
+        if options['stale'] is not None:
+            if options['stale'] < 1:
+                raise CommandError("--stale must be a positive integer.")
+            if options['resume']:
+                raise CommandError("--resume cannot be used with --stale.")
+        self.verbosity = int(options.get('verbosity', 1))
+        self.deadline = None
+        if options['time_budget'] is not None:
+            self.deadline = time.time() + options['time_budget']
+
+        engine = SyncEngine(using=options['database'],
+                            read_using=options['read_database'])
+        unknown = [list_id for list_id in options['lists'] 
+                   if not engine.list_exists(list_id)]
+        if unknown:
+            raise CommandError("Unknown MailChimp list ID: %s" % 
+                               ', '.join(unknown))
+        if options['statement_timeout'] is not None:
+            try:
+                engine.set_statement_timeout(options['statement_timeout'])
+            except NotImplementedError as e:
+                raise CommandError(unicode(e))
+        if options['estimate']:
+            if options['sample_size'] < 1:
+                raise CommandError("--sample-size must be a positive integer.")
+            try:
+                self.estimate(engine, options['lists'], options['sample_size'])
+            finally:
+                engine.close()
+            return
+        checkpoints = SyncCheckpoint.objects.using(engine.using)
+        if options['resume']:
+            try:
+                checkpoint = checkpoints.filter(finished=False,
+                                        mode=SyncCheckpoint.FULL)[0]
+            except IndexError:
+                raise CommandError("There is no unfinished run to resume.")
+            # the run must go on over the same rows
+            if options['lists'] and \
+               sorted(set(options['lists'])) != sorted(checkpoint.get_lists()):
+                raise CommandError("Run %s syncs %s; resume it without "
+                                   "--list." % (checkpoint.run_id, 
+                                   ', '.join(checkpoint.get_lists()) or
+                                   'every list'))
+            options['lists'] = checkpoint.get_lists()
+            if self.verbosity > 0:
+                self.stdout.write("Resuming run %s after subscription %d "
+                                  "(%d processed)\n" % (checkpoint.run_id,
+                                  checkpoint.last_pk, checkpoint.processed))
+        else:
+            mode = SyncCheckpoint.FULL
+            if options['stale'] is not None:
+                mode = SyncCheckpoint.STALE
+            checkpoint = checkpoints.create(run_id=uuid.uuid4().hex, mode=mode,
+                                            lists=' '.join(options['lists']))
+            created = 0
+            for list_id in options['lists'] or [get_list_id()]:
+                created += engine.ensure_subscriptions(list_id)
+            # the new rows may not have reached a lagging replica yet
+            if created:
+                engine.read_using = engine.using
+
+        subscriptions = engine.get_subscriptions(options['lists'])
+        stopped = False
+        try:
+            if options['stale'] is not None:
+                pks = engine.select_stale(options['stale'], options['lists'])
+                self.start_progress(engine, len(pks))
+                for chunk in chunks(pks, batch_size):
+                    if self.out_of_time():
+                        stopped = True
+                        break
+                    self.sync_batch(engine, checkpoint,
+                                    list(subscriptions.filter(pk__in=chunk)))
+            else:
+                total = None
+                if self.verbosity > 0:
+                    total = subscriptions.filter(
+                                pk__gt=checkpoint.last_pk).count()
+                self.start_progress(engine, total)
+                while not self.out_of_time():
+                    batch = list(subscriptions.filter(
+                                    pk__gt=checkpoint.last_pk)[:batch_size])
+                    if not batch:
+                        break
+                    self.sync_batch(engine, checkpoint, batch)
+                    checkpoint.last_pk = batch[-1].pk
+                    checkpoint.save()
+                else:
+                    # leave the run to be resumed
+                    stopped = True
+        finally:
+            engine.close()
+
+        self.refresh_counts(options['lists'])
+        checkpoint.finished = not stopped
+        checkpoint.stopped = stopped
+        report = self.get_report(engine, checkpoint, options)
+        if options['report']:
+            checkpoint.report = json.dumps(report)
+        checkpoint.save()
+        if self.verbosity > 0:
+            self.write_summary(report)
+
+    def estimate(self, engine, lists, sample_size):
+        estimate = DriftEstimate(engine, lists, sample_size).run()
+        labels = dict(UserSubscription.CHOICES)
+        self.stdout.write("%-16s %10s %8s %10s  %s\n" % ('Status', 
+                          'Population', 'Sampled', 'Mismatched', 
+                          'Estimated rate (95% interval)'))
+        for status, stratum in sorted(estimate.strata.items()):
+            self.stdout.write("%-16s %10d %8d %10d  %.1f%% (%.1f%% - %.1f%%)\n"
+                              % (labels.get(status, status),
+                                 stratum['population'], stratum['sampled'],
+                                 stratum['mismatched'], stratum['rate'] * 100,
+                                 stratum['interval'][0] * 100,
+                                 stratum['interval'][1] * 100))
+        self.stdout.write("Overall estimated mismatch rate: %.1f%% "
+                          "(%.1f%% - %.1f%%)\n" % (estimate.rate * 100,
+                          estimate.interval[0] * 100,
+                          estimate.interval[1] * 100))
+        for error in estimate.errors:
+            self.stderr.write("Error: %s\n" % error)
+
+    def refresh_counts(self, lists):
+        lists = lists or get_list_ids()
+        for list_id in lists:
+            refresh_counts(list_id)
+
+    def out_of_time(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def start_progress(self, engine, total):
+        """ Start measuring the run, of 'total' subscriptions if known. """
+        self.total = total
+        self.synced = 0
+        self.errors = 0
+        self.transitions = {}
+        self.started = self.last_progress = time.time()
+        self.calls_before = getattr(engine.get_client(), 'calls', 0)
+
+    def sync_batch(self, engine, checkpoint, batch):
+        """
+        Sync a batch, writing its output in one go rather than a line per
+        subscription.
+        """
+        before = dict((subscription.pk, subscription.status)
+                      for subscription in batch)
+        lines = []
+        errors = []
+        for subscription, error in engine.sync_batch(batch):
+            email = subscription.user.email
+            if error is not None:
+                checkpoint.record_error(subscription.user, unicode(error))
+                errors.append("%s\t\tError: %s\n" % (email, error))
+                self.errors += 1
+            else:
+                transition = (before[subscription.pk], subscription.status)
+                if transition[0] != transition[1]:
+                    self.transitions[transition] = \
+                        self.transitions.get(transition, 0) + 1
+                if self.verbosity > 2 or (self.verbosity > 1 and
+                                          transition[0] != transition[1]):
+                    lines.append("%s\t%s\t%s\n" % (email,
+                                 subscription.list_id,
+                                 subscription.get_status_display()))
+            checkpoint.processed += 1
+            self.synced += 1
+        checkpoint.save()
+        if lines:
+            self.stdout.write(''.join(lines))
+        if errors:
+            self.stderr.write(''.join(errors))
+        now = time.time()
+        if self.verbosity > 0 and \
+           now - self.last_progress >= self.progress_interval:
+            self.last_progress = now
+            self.write_progress(now - self.started)
+
+    def write_progress(self, elapsed):
+        rate = self.synced / elapsed if elapsed else 0.0
+        if self.total:
+            eta = '?'
+            if rate:
+                remaining = max(0, self.total - self.synced) / rate
+                eta = timedelta(seconds=int(remaining))
+            self.stdout.write("%d/%d subscriptions (%.1f%%), %.1f/s, "
+                              "ETA %s\n" % (self.synced, self.total,
+                              100.0 * self.synced / self.total, rate, eta))
+        else:
+            self.stdout.write("%d subscriptions, %.1f/s\n" % (self.synced,
+                                                              rate))
+
+    def get_report(self, engine, checkpoint, options):
+        """ The outcome of the run as a dict that can be serialized to JSON. """
+        duration = time.time() - self.started
+        labels = dict(UserSubscription.CHOICES)
+        transitions = {}
+        for (before, after), count in self.transitions.items():
+            transitions['%s -> %s' % (labels[before], labels[after])] = count
+        return {
+            'run_id': checkpoint.run_id,
+            'lists': options['lists'],
+            'mode': checkpoint.mode,
+            'stale': options['stale'],
+            'finished': checkpoint.finished,
+            'stopped': checkpoint.stopped,
+            'duration': round(duration, 3),
+            'synced': self.synced,
+            'errors': self.errors,
+            'api_calls': getattr(engine.get_client(), 'calls', 0) -
+                         self.calls_before,
+            'rate': round(self.synced / duration, 3) if duration else 0.0,
+            'transitions': transitions,
+            'processed': checkpoint.processed,
+            'total_errors': checkpoint.errors,
+        }
+
+    def write_summary(self, report):
+        outcome = 'finished'
+        if report['stopped']:
+            outcome = 'stopped by the time budget'
+        self.stdout.write("Run %s %s in %s: %d subscriptions (%.1f/s), "
+                          "%d errors, %d API calls\n" % (report['run_id'],
+                          outcome, timedelta(seconds=int(report['duration'])),
+                          report['synced'], report['rate'], report['errors'],
+                          report['api_calls']))
+        for transition, count in sorted(report['transitions'].items()):
+            self.stdout.write("  %-40s %d\n" % (transition, count))
+        if report['stopped'] and report['mode'] == SyncCheckpoint.FULL:
+            self.stdout.write("Continue the run with --resume\n")
@@ -0,0 +1,20 @@
+"""
+A per-request memo of UserSubscription lookups, keyed by (list ID, user pk).
+It is only active between activate() and deactivate(), which is done for each
+request by chimpusers.middleware.SubscriptionMemoMiddleware.
+"""
+import threading
+
+_local = threading.local()
+
+def activate():
+    """ Start a new, empty memo for the current thread. """
+    _local.memo = {}
+
+def deactivate():
+    """ Discard the memo of the current thread. """
+    _local.memo = None
+
+def get_memo():
+    """ Get the memo dict of the current thread, or None if not active. """
+    return getattr(_local, 'memo', None)
@@ -0,0 +1,62 @@
+import logging
+from django.db import transaction
+from chimpusers import memo
+from chimpusers.batching import OperationBatch
+
+logger = logging.getLogger('chimpusers')
+
+class SubscriptionMemoMiddleware(object):
+    """
+    Memoizes the UserSubscription lookups made with 
+    UserSubscription.objects.attach_to(), get_memoized() and the chimpusers
+    template filters for the duration of each request, so that each 
+    subscription is loaded at most once per request.
+    """
+    def process_request(self, request):
+        memo.activate()
+    
+    def process_response(self, request, response):
+        memo.deactivate()
+        return response
+    
+    def process_exception(self, request, exception):
+        memo.deactivate()
+
+
+class OperationBatchMiddleware(object):
+    """
+    Collects the MailChimp operations made on UserSubscription instances 
+    during each request in an OperationBatch and flushes them once when the
+    response is returned, or when the current transaction commits on Django
+    versions with transaction.on_commit(). Errors while flushing are logged
+    and do not affect the response.
+    """
+    def process_request(self, request):
+        request.chimpusers_batch = OperationBatch()
+        request.chimpusers_batch.activate()
+    
+    def process_response(self, request, response):
+        batch = getattr(request, 'chimpusers_batch', None)
+        if batch is not None:
+            batch.deactivate()
+            del request.chimpusers_batch
+            if len(batch):
+                if hasattr(transaction, 'on_commit'):
+                    transaction.on_commit(lambda: self.flush(batch))
+                else:
+                    self.flush(batch)
+        return response
+    
+    def process_exception(self, request, exception):
+        batch = getattr(request, 'chimpusers_batch', None)
+        if batch is not None:
+            batch.deactivate()
+            batch.discard()
+            del request.chimpusers_batch
+    
+    def flush(self, batch):
+        try:
+            for error in batch.flush():
+                logger.warning("MailChimp batch error: %s", error)
+        except Exception:
+            logger.exception("Error flushing MailChimp operations")
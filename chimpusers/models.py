@@ -1,24 +1,266 @@
 import logging
-from mailsnake import MailSnake
-from chimpusers.exceptions import MailChimpError
-from chimpusers.utils import get_list_id, raise_if_error
-from django.db import models
+import hashlib
+from chimpusers.exceptions import MailChimpError, MailChimpGroupingNotFound, \
+                                  MailChimpBaseException, \
+                                  MailChimpTransportError
+from chimpusers.groups import GroupingIndex
+from chimpusers.utils import (get_list_id, get_client, 
+                              raise_if_error, call_async, gather, chunks, 
+                              AsyncCall,
+                              atomic, get_error_emails,
+                              parse_timestamp)
+from chimpusers.memo import get_memo
+from chimpusers.batching import get_current_batch
+from chimpusers.scheduler import priority, BULK
+from django.db import models, connections
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
+from django.utils import timezone
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models import Count
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
 try:
     import cPickle as pickle
 except:
     import pickle
 import base64
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+def _status_cache_key(list_id, user_id):
+    return 'chimpusers:status:%s:%s' % (list_id, user_id)
+
+def _status_cache_timeout():
+    return getattr(settings, 'MAILCHIMP_STATUS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+class UserSubscriptionManager(models.Manager):
+    """ Adds list-aware lookups to UserSubscription.objects. """
+    def for_list(self, list_id=None):
+        """ 
+        Subscriptions for the given list ID, or the MAILCHIMP_LIST_ID list if
+        not provided.
+        """
+        return self.filter(list_id=list_id or get_list_id())
+    
+    def get_for_user(self, user, list_id=None):
+        """ 
+        Get (or create) the subscription of 'user' to the given list ID, or 
+        the MAILCHIMP_LIST_ID list if not provided.
+        """
+        subscription, created = self.get_or_create(user=user, 
+                                    list_id=list_id or get_list_id())
+        return subscription
+    
+    def attach_to(self, users, list_id=None):
+        """
+        Load the subscriptions of 'users' to the list ID, or the 
+        MAILCHIMP_LIST_ID list if not provided, with a single query and attach
+        them to the users so that get_memoized() needs no further queries. 
+        Subscriptions already memoized for the current request are not loaded
+        again.
+        
+        Returns the users as a list.
+        """
+        list_id = list_id or get_list_id()
+        users = list(users)
+        memo = get_memo()
+        missing = [user.pk for user in users 
+                   if memo is None or (list_id, user.pk) not in memo]
+        found = {}
+        for chunk in chunks(missing, 500):
+            for subscription in self.filter(list_id=list_id, user__in=chunk):
+                found[subscription.user_id] = subscription
+        for user in users:
+            if memo is not None and (list_id, user.pk) in memo:
+                subscription = memo[(list_id, user.pk)]
+            else:
+                subscription = found.get(user.pk)
+                if memo is not None:
+                    memo[(list_id, user.pk)] = subscription
+            if not hasattr(user, '_chimp_subscriptions'):
+                user._chimp_subscriptions = {}
+            user._chimp_subscriptions[list_id] = subscription
+        return users
+    
+    def get_memoized(self, user, list_id=None):
+        """
+        Get the subscription of 'user' to the list ID, or the MAILCHIMP_LIST_ID
+        list if not provided, or None if there is none. Uses the subscription 
+        attached by attach_to() or memoized for the current request if 
+        available.
+        """
+        list_id = list_id or get_list_id()
+        attached = getattr(user, '_chimp_subscriptions', {})
+        if list_id not in attached:
+            self.attach_to([user], list_id)
+        return user._chimp_subscriptions[list_id]
+    
+    def get_cached_status(self, user, list_id=None):
+        """
+        Get the status of the subscription of 'user' (a User or its pk) to the
+        list ID, or the MAILCHIMP_LIST_ID list if not provided, from Django's 
+        cache. The cache is written through whenever a subscription is saved,
+        so the database is only queried on a cache miss.
+        """
+        user_id = getattr(user, 'pk', user)
+        return self.get_cached_statuses([user_id], list_id)[user_id]
+    
+    def get_cached_statuses(self, users, list_id=None):
+        """
+        Like get_cached_status() for many users at once, with a single cache
+        call and at most one query. Returns a dict of user pks to statuses; 
+        users without a subscription have the UNKNOWN status.
+        """
+        list_id = list_id or get_list_id()
+        user_ids = [getattr(user, 'pk', user) for user in users]
+        keys = dict((_status_cache_key(list_id, user_id), user_id) 
+                    for user_id in user_ids)
+        statuses = dict((keys[key], status) 
+                        for key, status in cache.get_many(keys.keys()).items())
+        missing = [user_id for user_id in user_ids if user_id not in statuses]
+        if missing:
+            found = {}
+            for chunk in chunks(missing, 500):
+                rows = self.filter(list_id=list_id, user__in=chunk) \
+                           .values_list('user_id', 'status')
+                found.update(rows)
+            for user_id in missing:
+                statuses[user_id] = found.get(user_id, UserSubscription.UNKNOWN)
+            cache.set_many(dict((_status_cache_key(list_id, user_id), 
+                                 statuses[user_id]) for user_id in missing), 
+                           _status_cache_timeout())
+        return statuses
+    
+    def refresh_cached_statuses(self, queryset=None):
+        """
+        Write the statuses of the subscriptions in 'queryset' through to the
+        cache. Must be called after changing statuses with QuerySet.update() 
+        or bulk_create(), which bypass save().
+        """
+        if queryset is None:
+            queryset = self.all()
+        rows = queryset.values_list('list_id', 'user_id', 'status').iterator()
+        for chunk in chunks(rows, 500):
+            cache.set_many(dict((_status_cache_key(list_id, user_id), status) 
+                                for list_id, user_id, status in chunk),
+                           _status_cache_timeout())
+    
+    def push_merge_vars(self, build_merge_vars, queryset=None, list_id=None,
+                        chunk_size=500, progress=None):
+        """
+        Update the merge vars of many members of the list ID, or the
+        MAILCHIMP_LIST_ID list if not provided, eg. after a data migration.
+        'build_merge_vars' is called with each user and returns a dict of
+        merge vars (FNAME and LNAME are added) or None to skip the user.
+
+        Only the SUBSCRIBED subscriptions in 'queryset' (all by default) are
+        updated, with one listBatchSubscribe call per chunk with
+        update_existing=True and replace_interests=False. Subscriptions whose
+        merge vars are the same as those last pushed are skipped, as in
+        update(). The calls are made as bulk calls within the rate budget.
+        'progress' may be a callable which is passed the updated count and
+        the errors so far after each chunk.
+
+        Returns the number of members updated and a list of the errors.
+        """
+        list_id = list_id or get_list_id()
+        if queryset is None:
+            queryset = self.all()
+        queryset = queryset.filter(list_id=list_id, 
+                                   status=UserSubscription.SUBSCRIBED) \
+                           .select_related('user').order_by('pk')
+        ms = get_client()
+        updated = 0
+        errors = []
+        last_pk = 0
+        with priority(BULK):
+            while True:
+                chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+                if not chunk:
+                    break
+                last_pk = chunk[-1].pk
+                pushes = []
+                for subscription in chunk:
+                    merge_vars = build_merge_vars(subscription.user)
+                    if merge_vars is None:
+                        continue
+                    kwargs = {'merge_vars': dict(merge_vars)}
+                    fingerprint = subscription.get_merge_fingerprint(kwargs)
+                    if fingerprint != subscription.merge_fingerprint:
+                        pushes.append((subscription, kwargs, fingerprint))
+                if pushes:
+                    updated += self._push_chunk(ms, list_id, pushes, errors)
+                if progress:
+                    progress(updated, errors)
+        return updated, errors
+
+    def _push_chunk(self, ms, list_id, pushes, errors):
+        """
+        Send one chunk of push_merge_vars() and record the fingerprints of the
+        members updated. Returns their number.
+        """
+        batch = []
+        for subscription, kwargs, fingerprint in pushes:
+            row = dict(kwargs['merge_vars'])
+            row['EMAIL'] = subscription.user.email
+            row['FNAME'] = subscription.user.first_name
+            row['LNAME'] = subscription.user.last_name
+            batch.append(row)
+        response = ms.listBatchSubscribe(id=list_id, batch=batch,
+                                         double_optin=False,
+                                         update_existing=True,
+                                         replace_interests=False)
+        raise_if_error(response)
+        errors.extend(response.get('errors', []))
+        failed = get_error_emails(response)
+        done = [(subscription, kwargs, fingerprint)
+                for subscription, kwargs, fingerprint in pushes
+                if subscription.user.email.lower() not in failed]
+        by_fingerprint = {}
+        interests = []
+        for subscription, kwargs, fingerprint in done:
+            subscription.merge_fingerprint = fingerprint
+            by_fingerprint.setdefault(fingerprint, []).append(subscription.pk)
+            if 'GROUPINGS' in kwargs['merge_vars']:
+                interests.append((subscription, 
+                                  kwargs['merge_vars']['GROUPINGS']))
+        masks = []
+        if interests:
+            known = InterestGrouping.objects.db_manager(self.db).get_known_for(
+                        [grouping for subscription, groupings in interests
+                         for grouping in groupings], list_id)
+            masks = [(subscription, subscription.get_interest_masks(groupings,
+                                                                    known))
+                     for subscription, groupings in interests]
+        with atomic(using=self.db):
+            for fingerprint, pks in by_fingerprint.items():
+                self.filter(pk__in=pks).update(merge_fingerprint=fingerprint)
+            MemberInterests.objects.db_manager(self.db).store(masks, 
+                                                              replace=False)
+        return len(done)
+
+    def in_group(self, group_name, grouping_name=None, list_id=None):
+        """
+        Subscriptions whose locally stored interests include the named group.
+        See MemberInterests.objects.in_group().
+        """
+        manager = MemberInterests.objects.db_manager(self.db)
+        grouping, bit = manager.get_group_bit(group_name, grouping_name,
+                                              list_id)
+        return self.filter(interests__grouping=grouping).extra(
+                    where=[manager.mask_where()], params=[bit])
+
 
 class UserSubscription(models.Model):
     """
-    Stores a user's MailChimp subscription status and provides some wrappers
-    around the MailSnake API calls to subscribe, update, and unsubscribe the
-    user.
+    Stores a user's MailChimp subscription status for one list and provides 
+    some wrappers around the MailSnake API calls to subscribe, update, and 
+    unsubscribe the user. A user has one UserSubscription per list.
     """
     UNKNOWN = 0
     NOT_SUBSCRIBED = 1
@@ -34,13 +276,33 @@ class UserSubscription(models.Model):
         (PENDING, 'Pending'),
         (CLEANED, 'Cleaned')
     )
-    user = models.OneToOneField(User)
+    # maps the member status strings used by the API to the choices above
+    API_STATUSES = {
+        'unsubscribed': UNSUBSCRIBED,
+        'pending': PENDING,
+        'cleaned': CLEANED,
+        'subscribed': SUBSCRIBED,
+    }
+    user = models.ForeignKey(User)
+    list_id = models.CharField(max_length=32, default=get_list_id, 
+                               db_index=True)
     status = models.PositiveIntegerField(choices=CHOICES, default=UNKNOWN)
     optin_time = models.DateTimeField(null=True, blank=True)
     optin_ip = models.IPAddressField(null=True, blank=True)
+    # fingerprint of the merge vars last pushed by subscribe() or update()
+    merge_fingerprint = models.CharField(max_length=40, blank=True, 
+                                         editable=False)
+    # when the member info was last fetched, and how often it had changed
+    last_synced = models.DateTimeField(null=True, blank=True, editable=False,
+                                       db_index=True)
+    change_count = models.PositiveIntegerField(default=0, editable=False,
+                                               db_index=True)
 
     class Meta:
         db_table = 'mailchimp_user_subscription'
+        unique_together = (('user', 'list_id'),)
+    
+    objects = UserSubscriptionManager()
         
     def sync(self, save=True):
         """ 
@@ -54,52 +316,127 @@ class UserSubscription(models.Model):
         MailChimpError if the API returned an error.
         
         See: http://apidocs.mailchimp.com/api/1.3/listmemberinfo.func.php
+        
+        Within an OperationBatch the call is deferred until the batch is 
+        flushed and None is returned.
         """
-        kwargs = {'email_address': self.user.email, 'id': get_list_id()}
+        batch = get_current_batch()
+        if batch is not None:
+            return batch.add(self, 'sync', {'save': save})
+        kwargs = {'email_address': self.user.email, 'id': self.list_id}
         response = self.get_mailsnake_instance().listMemberInfo(**kwargs)
+        return self._synced(response, save)
+    
+    def _synced(self, response, save):
+        """ Apply a listMemberInfo response as described in sync(). """
         if not response['success']:
-            self.status = self.NOT_SUBSCRIBED
-            self.optin_time = None
-            self.optin_ip = None
             data = None
         else:
             data = response['data'][0]
-            
-            if data['status'] == 'unsubscribed':
-                self.status = self.UNSUBSCRIBED
-            elif data['status'] == 'pending':
-                self.status = self.PENDING
-            elif data['status'] == 'cleaned':
-                self.status = self.CLEANED
-            elif data['status'] == 'subscribed':
-                self.status = self.SUBSCRIBED
-            else: 
-                self.status = self.UNKNOWN
-            
-            if data['ip_opt']:
-                self.optin_ip = data['ip_opt']
-            if data['timestamp']:
-                self.optin_time = data['timestamp']
+        self.set_member_info(data)
         
         if save:
             self.save()
+            if data:
+                self.set_interests(data['merges'].get('GROUPINGS', []))
         
         return data
     
+    def set_member_info(self, data):
+        """
+        Populate the model fields from one member of the 'data' portion of a
+        listMemberInfo response. If 'data' is None or an error, the user is
+        not a member of the list. Sets last_synced, and increments 
+        change_count if the member info changed. The instance is not saved.
+        
+        Returns True if any of the fields were changed.
+        """
+        before = (self.status, self.optin_time, self.optin_ip)
+        status = self.status
+        self.status = self.status_from_member_info(data)
+        if self.status == self.NOT_SUBSCRIBED:
+            self.optin_time = None
+            self.optin_ip = None
+        else:
+            if data['ip_opt']:
+                self.optin_ip = data['ip_opt']
+            if data['timestamp']:
+                self.optin_time = parse_timestamp(data['timestamp'])
+        if self.status != status:
+            # the member was changed outside of this app
+            self.merge_fingerprint = ''
+        self.last_synced = timezone.now()
+        changed = before != (self.status, self.optin_time, self.optin_ip)
+        if changed:
+            self.change_count += 1
+        return changed
+    
+    @classmethod
+    def status_from_member_info(cls, data):
+        """ 
+        Get the status for one member of the 'data' portion of a 
+        listMemberInfo response, as in set_member_info().
+        """
+        if not data or 'error' in data:
+            return cls.NOT_SUBSCRIBED
+        return cls.API_STATUSES.get(data['status'], cls.UNKNOWN)
+    
+    def set_interests(self, groupings, replace=True, known=None, using=None):
+        """
+        Store the interest groups of this member locally as one bitmask per
+        grouping. 'groupings' is a list of dicts with an 'id' or 'name' and a
+        'groups' string, as in the GROUPINGS merge var. If 'replace' is False
+        the groups are added to those already stored.
+        
+        See get_interest_masks() for 'known'. 'using' is the database alias 
+        to write to.
+        """
+        masks = self.get_interest_masks(groupings, known, using)
+        MemberInterests.objects.db_manager(using).store([(self, masks)],
+                                                        replace)
+    
+    def get_interest_masks(self, groupings, known=None, using=None):
+        """
+        Convert 'groupings', as for set_interests(), to a dict of 
+        InterestGrouping instances to bitmasks.
+        
+        'known' may be the result of InterestGrouping.objects.get_known() for
+        this list to save a query. Otherwise the stored groupings are used, 
+        and refreshed from the API if one is missing; see 
+        InterestGrouping.objects.refresh_missing(). Groupings that are still
+        unknown are left out.
+        """
+        if known is None:
+            known = InterestGrouping.objects.db_manager(using).get_known_for(
+                                                        groupings, self.list_id)
+        masks = {}
+        for grouping in groupings:
+            local = known.get(grouping.get('id')) or \
+                    known.get(grouping.get('name'))
+            if local is None:
+                continue
+            index = local.get_index()
+            masks[local] = index.mask(index.parse(grouping.get('groups')))
+        return masks
+    
     def get_mailsnake_instance(self):
         """
-        Get the instance of the mailsnake.MailSnake class based on
-        MAILCHIMP_API_KEY defined in the configuration settings.
+        Get the client used for the API calls, which has the same interface as
+        mailsnake.MailSnake. See chimpusers.utils.get_client().
         """
-        try:
-            return self._ms
-        except AttributeError:
-            if not hasattr(settings, 'MAILCHIMP_API_KEY'):
-                errstr = _("You need to specify MAILCHIMP_LIST_ID in your " \
-                           "Django settings file.")
-                raise ImproperlyConfigured(errstr)                              
-            self._ms = MailSnake(settings.MAILCHIMP_API_KEY)
-            return self._ms
+        return get_client()
+    
+    def get_merge_fingerprint(self, kwargs):
+        """
+        Get a fingerprint of the merge vars (including FNAME and LNAME) and the 
+        email type in the keyword arguments of a subscribe() or update() call.
+        """
+        merge_vars = dict(kwargs.get('merge_vars') or {})
+        merge_vars['FNAME'] = self.user.first_name
+        merge_vars['LNAME'] = self.user.last_name
+        data = json.dumps([merge_vars, kwargs.get('email_type')], 
+                          sort_keys=True, default=unicode)
+        return hashlib.sha1(data).hexdigest()
     
     def is_subscribed(self):
         """ Convenience to determine if user is subscribed. """
@@ -123,30 +460,72 @@ class UserSubscription(models.Model):
             
         Returns True if the user was subscribed, False if the user was not
         subscribed, or raises a MailChimpError if the API returned an error.
-        """
-        kwargs['email_address'] = self.user.email
-        kwargs['id'] = get_list_id()
-        if not 'merge_vars' in kwargs:
-            kwargs['merge_vars'] = {}
-        kwargs['merge_vars']['FNAME'] = self.user.first_name
-        kwargs['merge_vars']['LNAME'] = self.user.last_name
+        Within an OperationBatch the call is deferred until the batch is 
+        flushed and True is returned.
         
+        If the user is already subscribed with the same merge vars nothing is 
+        sent and True is returned, unless 'force' is True.
+        """
+        if self._is_unchanged(kwargs, (self.SUBSCRIBED,)):
+            return True
+        batch = get_current_batch()
+        if batch is not None:
+            return batch.add(self, 'subscribe', kwargs)
+        kwargs = self._member_kwargs(kwargs, True)
         response = self.get_mailsnake_instance().listSubscribe(**kwargs)
+        return self._subscribed(kwargs, response)
+    
+    def _is_unchanged(self, kwargs, statuses):
+        """
+        Pop 'force' from the keyword arguments of a subscribe() or update() 
+        call and return True if the call can be skipped, ie. the status is one
+        of 'statuses' and the merge vars are those last pushed.
+        """
+        force = kwargs.pop('force', False)
+        return not force and self.status in statuses and \
+               self.merge_fingerprint == self.get_merge_fingerprint(kwargs)
+    
+    def _member_kwargs(self, kwargs, merge_vars=False):
+        """
+        Add the list ID, the email address and, if 'merge_vars' is True, the 
+        FNAME and LNAME merge vars of this user to the keyword arguments of an
+        API call.
+        """
+        kwargs['email_address'] = self.user.email
+        kwargs['id'] = self.list_id
+        if merge_vars:
+            if not 'merge_vars' in kwargs:
+                kwargs['merge_vars'] = {}
+            kwargs['merge_vars']['FNAME'] = self.user.first_name
+            kwargs['merge_vars']['LNAME'] = self.user.last_name
+        return kwargs
+    
+    def _subscribed(self, kwargs, response):
+        """ Apply a listSubscribe response as described in subscribe(). """
         raise_if_error(response)
         if response:
-            if 'merge_vars' in kwargs:
-                merge_vars = kwargs['merge_vars']
-                if 'OPTIN_IP' in merge_vars:
-                    self.optin_ip = merge_vars['OPTIN_IP']
-                if 'OPTIN_TIME' in merge_vars:
-                    self.optin_time = merge_vars['OPTIN_TIME']
-            if 'double_optin' in kwargs and not kwargs['double_optin']:
-                self.status = self.SUBSCRIBED
-            else:
-                self.status = self.PENDING
-            self.save()
-            
+            self.set_subscribed(kwargs)
         return response
+    
+    def set_subscribed(self, kwargs):
+        """ 
+        Update and save this instance after a successful listSubscribe call 
+        made with the keyword arguments 'kwargs'.
+        """
+        merge_vars = kwargs.get('merge_vars', {})
+        if 'OPTIN_IP' in merge_vars:
+            self.optin_ip = merge_vars['OPTIN_IP']
+        if 'OPTIN_TIME' in merge_vars:
+            self.optin_time = merge_vars['OPTIN_TIME']
+        if 'double_optin' in kwargs and not kwargs['double_optin']:
+            self.status = self.SUBSCRIBED
+        else:
+            self.status = self.PENDING
+        self.merge_fingerprint = self.get_merge_fingerprint(kwargs)
+        self.save()
+        if 'GROUPINGS' in merge_vars:
+            self.set_interests(merge_vars['GROUPINGS'], 
+                               kwargs.get('replace_interests', True))
 
     def update(self, **kwargs):
         """ 
@@ -164,16 +543,30 @@ class UserSubscription(models.Model):
             
         Returns True if the user was udpated, False if the user was not
         unsubscribed, or raises a MailChimpError if the API returned an error.
-        """
-        kwargs['email_address'] = self.user.email
-        kwargs['id'] = get_list_id()
-        if not 'merge_vars' in kwargs:
-            kwargs['merge_vars'] = {}
-        kwargs['merge_vars']['FNAME'] = self.user.first_name
-        kwargs['merge_vars']['LNAME'] = self.user.last_name
+        Within an OperationBatch the call is deferred until the batch is 
+        flushed and True is returned.
         
+        If the merge vars are the same as those last pushed nothing is sent
+        and True is returned, unless 'force' is True.
+        """
+        if self._is_unchanged(kwargs, (self.SUBSCRIBED, self.PENDING)):
+            return True
+        batch = get_current_batch()
+        if batch is not None:
+            return batch.add(self, 'update', kwargs)
+        kwargs = self._member_kwargs(kwargs, True)
         response = self.get_mailsnake_instance().listUpdateMember(**kwargs)
+        return self._updated(kwargs, response)
+    
+    def _updated(self, kwargs, response):
+        """ Apply a listUpdateMember response as described in update(). """
         raise_if_error(response)
+        if response:
+            self.merge_fingerprint = self.get_merge_fingerprint(kwargs)
+            self.save()
+            if 'GROUPINGS' in kwargs['merge_vars']:
+                self.set_interests(kwargs['merge_vars']['GROUPINGS'], 
+                                   kwargs.get('replace_interests', True))
         
         return response
     
@@ -191,19 +584,78 @@ class UserSubscription(models.Model):
             
         Returns True if the user was unsubscribed, False if the user was not
         unsubscribed, or raises a MailChimpError if the API returned an error.
+        Within an OperationBatch the call is deferred until the batch is 
+        flushed and True is returned.
         """
-        kwargs['email_address'] = self.user.email
-        kwargs['id'] = get_list_id()
+        batch = get_current_batch()
+        if batch is not None:
+            return batch.add(self, 'unsubscribe', kwargs)
+        kwargs = self._member_kwargs(kwargs)
         response = self.get_mailsnake_instance().listUnsubscribe(**kwargs)
+        return self._unsubscribed(kwargs, response)
+    
+    def _unsubscribed(self, kwargs, response):
+        """ 
+        Apply a listUnsubscribe response as described in unsubscribe(). 
+        """
         raise_if_error(response)
         if response:
-            if 'delete_member' in kwargs and kwargs['delete_member']:
-                self.status = self.NOT_SUBSCRIBED
-            else:
-                self.status = self.UNSUBSCRIBED
-            self.save()
+            self.set_unsubscribed(kwargs)
         return response
     
+    def set_unsubscribed(self, kwargs):
+        """ 
+        Update and save this instance after a successful listUnsubscribe call
+        made with the keyword arguments 'kwargs'.
+        """
+        if 'delete_member' in kwargs and kwargs['delete_member']:
+            self.status = self.NOT_SUBSCRIBED
+        else:
+            self.status = self.UNSUBSCRIBED
+        self.save()
+    
+    def async_sync(self, save=True):
+        """
+        Like sync(), but the API call is made in the shared thread pool so 
+        that several calls can be in flight at once. Returns an 
+        chimpusers.utils.AsyncCall; its get() method applies the response to 
+        this instance in the calling thread, returning the result of sync() or
+        raising its exception. Calls are not deferred by an OperationBatch.
+        """
+        kwargs = self._member_kwargs({})
+        return AsyncCall(
+                call_async(self.get_mailsnake_instance().listMemberInfo, 
+                           **kwargs),
+                lambda response: self._synced(response, save))
+    
+    def asubscribe(self, **kwargs):
+        """ Like subscribe(), but returns an AsyncCall. See async_sync(). """
+        if self._is_unchanged(kwargs, (self.SUBSCRIBED,)):
+            return AsyncCall(None, lambda response: True)
+        kwargs = self._member_kwargs(kwargs, True)
+        return AsyncCall(
+                call_async(self.get_mailsnake_instance().listSubscribe, 
+                           **kwargs),
+                lambda response: self._subscribed(kwargs, response))
+    
+    def aupdate(self, **kwargs):
+        """ Like update(), but returns an AsyncCall. See async_sync(). """
+        if self._is_unchanged(kwargs, (self.SUBSCRIBED, self.PENDING)):
+            return AsyncCall(None, lambda response: True)
+        kwargs = self._member_kwargs(kwargs, True)
+        return AsyncCall(
+                call_async(self.get_mailsnake_instance().listUpdateMember, 
+                           **kwargs),
+                lambda response: self._updated(kwargs, response))
+    
+    def aunsubscribe(self, **kwargs):
+        """ Like unsubscribe(), but returns an AsyncCall. See async_sync(). """
+        kwargs = self._member_kwargs(kwargs)
+        return AsyncCall(
+                call_async(self.get_mailsnake_instance().listUnsubscribe, 
+                           **kwargs),
+                lambda response: self._unsubscribed(kwargs, response))
+    
     def __unicode__(self):
         return self.user.email
 
@@ -225,33 +677,565 @@ class SerializedDataField(models.TextField):
         return base64.b64encode(pickle.dumps(value))
         
         
+class InterestGroupingManager(models.Manager):
+    REFRESH_INTERVAL = 60 * 60
+    
+    def refresh(self, list_id=None):
+        """
+        Store the interest groupings of the given list ID, or the 
+        MAILCHIMP_LIST_ID list if not provided, from the listInterestGroupings
+        API call. Returns the same dict as get_known().
+        """
+        list_id = list_id or get_list_id()
+        response = get_client().listInterestGroupings(id=list_id)
+        raise_if_error(response)
+        for grouping in response:
+            groups = [(group['bit'], group['name']) 
+                      for group in grouping['groups']]
+            local, created = self.get_or_create(list_id=list_id, 
+                                grouping_id=grouping['id'],
+                                defaults={'name': grouping['name'], 
+                                          'form_field': grouping['form_field'],
+                                          'groups': groups})
+            if not created:
+                local.name = grouping['name']
+                local.form_field = grouping['form_field']
+                local.groups = groups
+                local.save()
+        return self.get_known(list_id)
+    
+    def refresh_missing(self, list_id=None):
+        """
+        Refresh the groupings of a list after a member was found in a grouping
+        that is not stored, at most once every REFRESH_INTERVAL seconds per 
+        list across processes. Returns the same dict as get_known(), or None
+        if the groupings were refreshed recently or could not be fetched.
+        """
+        list_id = list_id or get_list_id()
+        key = 'chimpusers:groupings:refreshed:%s' % list_id
+        if not cache.add(key, True, self.REFRESH_INTERVAL):
+            return None
+        try:
+            return self.refresh(list_id)
+        except MailChimpBaseException:
+            # eg. interest groups are not enabled for the list
+            return None
+    
+    def get_known(self, list_id=None):
+        """
+        Get the stored groupings of a list as a dict keyed by both grouping ID
+        and grouping name.
+        """
+        known = {}
+        for grouping in self.filter(list_id=list_id or get_list_id()):
+            known[grouping.grouping_id] = grouping
+            known[grouping.name] = grouping
+        return known
+    
+    def get_known_for(self, groupings, list_id=None):
+        """
+        Like get_known(), but refreshes the groupings with refresh_missing()
+        if any of 'groupings', as for UserSubscription.set_interests(), is
+        not stored.
+        """
+        known = self.get_known(list_id)
+        if [grouping for grouping in groupings 
+            if grouping.get('id') not in known and 
+               grouping.get('name') not in known]:
+            known = self.refresh_missing(list_id) or known
+        return known
+    
+    def get_grouping(self, grouping_name=None, list_id=None):
+        """ 
+        Get a stored grouping by name, or the first grouping if no name is 
+        provided. Raises MailChimpGroupingNotFound.
+        """
+        groupings = self.filter(list_id=list_id or get_list_id())
+        if grouping_name:
+            groupings = groupings.filter(name=grouping_name)
+        try:
+            return groupings.order_by('pk')[0]
+        except IndexError:
+            errmsg = _("Grouping not found: '%s'") % grouping_name
+            raise MailChimpGroupingNotFound(errmsg)
+
+
+class InterestGrouping(models.Model):
+    """
+    A local copy of an interest grouping of a MailChimp list, as returned by
+    listInterestGroupings. 'groups' is a list of (bit, name) tuples.
+    """
+    list_id = models.CharField(max_length=32, db_index=True)
+    grouping_id = models.PositiveIntegerField()
+    name = models.CharField(max_length=100)
+    form_field = models.CharField(max_length=20)
+    groups = SerializedDataField()
+    updated = models.DateTimeField(auto_now=True)
+    
+    objects = InterestGroupingManager()
+    
+    class Meta:
+        db_table = 'mailchimp_interest_grouping'
+        unique_together = (('list_id', 'grouping_id'),)
+    
+    def get_index(self):
+        """ Get a GroupingIndex for this grouping. """
+        try:
+            return self._index
+        except AttributeError:
+            self._index = GroupingIndex({'id': self.grouping_id, 
+                'name': self.name, 'form_field': self.form_field,
+                'groups': [{'bit': bit, 'name': name} 
+                           for bit, name in self.groups]})
+            return self._index
+    
+    def __unicode__(self):
+        return self.name
+
+
+class MemberInterestsManager(models.Manager):
+    def in_group(self, group_name, grouping_name=None, list_id=None):
+        """
+        The stored interests that include the named group of the named 
+        grouping, or the first grouping if no name is provided. Raises
+        MailChimpGroupingNotFound.
+        """
+        grouping, bit = self.get_group_bit(group_name, grouping_name, list_id)
+        return self.filter(grouping=grouping).extra(where=[self.mask_where()],
+                                                    params=[bit])
+    
+    def get_group_bit(self, group_name, grouping_name=None, list_id=None):
+        """ 
+        Get the stored grouping and the bit of the named group, as for 
+        in_group(). 
+        """
+        grouping = InterestGrouping.objects.db_manager(self.db).get_grouping(
+                                                    grouping_name, list_id)
+        try:
+            return grouping, int(grouping.get_index().by_name[group_name])
+        except KeyError:
+            errmsg = _("Group not found: '%s'") % group_name
+            raise MailChimpGroupingNotFound(errmsg)
+    
+    def mask_where(self):
+        """ 
+        The condition on the mask column for a group bit, which also holds 
+        when the table is joined to from UserSubscription.
+        """
+        quote_name = connections[self.db].ops.quote_name
+        return '%s.%s & %%s != 0' % (quote_name(self.model._meta.db_table),
+                                     quote_name('mask'))
+    
+    def store(self, masks, replace=True):
+        """
+        Store the masks of many members at once. 'masks' is a list of 
+        (subscription, {grouping: mask}) tuples. If 'replace' is False the 
+        groups are added to those already stored.
+        
+        The existing rows are read with one query per 500 subscriptions, 
+        changed rows are updated with one query per distinct mask and new 
+        rows are inserted with bulk_create(), in one transaction.
+        """
+        masks = [(subscription, groupings) for subscription, groupings in masks
+                 if groupings]
+        existing = {}
+        for chunk in chunks(masks, 500):
+            rows = self.filter(subscription__in=[subscription.pk for 
+                                                 subscription, groupings
+                                                 in chunk]) \
+                       .values_list('subscription', 'grouping', 'pk', 'mask')
+            for subscription_id, grouping_id, pk, mask in rows:
+                existing[(subscription_id, grouping_id)] = (pk, mask)
+        updates = {}
+        new = []
+        for subscription, groupings in masks:
+            for grouping, mask in groupings.items():
+                key = (subscription.pk, grouping.pk)
+                if key not in existing:
+                    new.append(self.model(subscription_id=subscription.pk,
+                                          grouping_id=grouping.pk, mask=mask))
+                    continue
+                pk, stored = existing[key]
+                if not replace:
+                    mask |= stored
+                if mask != stored:
+                    updates.setdefault(mask, []).append(pk)
+        with atomic(using=self.db):
+            for mask, pks in updates.items():
+                for chunk in chunks(pks, 500):
+                    self.filter(pk__in=chunk).update(mask=mask)
+            if new:
+                self.bulk_create(new)
+    
+    def group_counts(self, grouping_name=None, list_id=None, 
+                     status=None):
+        """
+        Count the members in each group of the named grouping, or the first 
+        grouping if no name is provided, with a single query. Only members
+        with the given status are counted, by default those subscribed.
+        
+        Returns a dict of group names to counts.
+        """
+        if status is None:
+            status = UserSubscription.SUBSCRIBED
+        grouping = InterestGrouping.objects.get_grouping(grouping_name, 
+                                                         list_id)
+        rows = self.filter(grouping=grouping, subscription__status=status) \
+                   .values_list('mask').annotate(count=Count('pk'))
+        index = grouping.get_index()
+        counts = dict((name, 0) for bit, name in index.groups)
+        for mask, count in rows:
+            for name in index.names_for_mask(mask):
+                counts[name] += count
+        return counts
+
+
+class MemberInterests(models.Model):
+    """
+    The interest groups of a member in one grouping, stored as a bitmask of 
+    the group bits, so that segments can be queried without API calls.
+    """
+    subscription = models.ForeignKey(UserSubscription, 
+                                     related_name='interests')
+    grouping = models.ForeignKey(InterestGrouping)
+    mask = models.BigIntegerField(default=0, db_index=True)
+    
+    objects = MemberInterestsManager()
+    
+    class Meta:
+        db_table = 'mailchimp_member_interests'
+        unique_together = (('subscription', 'grouping'),)
+    
+    def get_group_names(self):
+        return self.grouping.get_index().names_for_mask(self.mask)
+    
+    def __unicode__(self):
+        return u"%s: %s" % (self.grouping, ", ".join(self.get_group_names()))
+
+
+class PendingUserSubscriptionManager(models.Manager):
+    BATCH_OPTIONS = ('double_optin', 'update_existing', 'replace_interests')
+    
+    def flush(self, queryset=None, chunk_size=500, list_id=None, 
+              progress=None, **kwargs):
+        """
+        Subscribe the users of the pending subscriptions in 'queryset' (all of
+        them by default) to the list ID, or the MAILCHIMP_LIST_ID list if not
+        provided, with one listBatchSubscribe call per chunk, passing the 
+        stored merge_vars of each row. The keyword arguments double_optin, 
+        update_existing and replace_interests are passed to 
+        listBatchSubscribe.
+        
+        For each chunk the UserSubscription statuses of the subscribed users
+        are updated in bulk and their pending rows deleted in one transaction.
+        Rows of users that MailChimp reported errors for are kept. 'progress'
+        may be a callable which is passed the subscribed count and the errors
+        so far after each chunk.
+        
+        Returns the number of users subscribed and a list of the errors.
+        """
+        for name in kwargs:
+            if name not in self.BATCH_OPTIONS:
+                raise TypeError("Unexpected keyword argument '%s'" % name)
+        list_id = list_id or get_list_id()
+        if queryset is None:
+            queryset = self.all()
+        queryset = queryset.select_related('user').order_by('pk')
+        if kwargs.get('double_optin', True):
+            status = UserSubscription.PENDING
+        else:
+            status = UserSubscription.SUBSCRIBED
+        
+        ms = get_client()
+        subscribed = 0
+        errors = []
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            batch = []
+            for pending in chunk:
+                row = dict(pending.merge_vars or {})
+                row['EMAIL'] = pending.user.email
+                row['FNAME'] = pending.user.first_name
+                row['LNAME'] = pending.user.last_name
+                batch.append(row)
+            response = ms.listBatchSubscribe(id=list_id, batch=batch, **kwargs)
+            raise_if_error(response)
+            errors.extend(response.get('errors', []))
+            failed = get_error_emails(response)
+            done = [pending for pending in chunk 
+                    if pending.user.email.lower() not in failed]
+            with atomic():
+                self._set_subscribed(done, list_id, status)
+                self.filter(pk__in=[pending.pk for pending in done]).delete()
+            subscribed += len(done)
+            if progress:
+                progress(subscribed, errors)
+        return subscribed, errors
+    
+    def _set_subscribed(self, pendings, list_id, status):
+        """ Update the UserSubscription rows of subscribed pending rows. """
+        user_ids = [pending.user_id for pending in pendings]
+        existing = set(UserSubscription.objects.for_list(list_id)
+                           .filter(user__in=user_ids)
+                           .values_list('user_id', flat=True))
+        updates = {}
+        new = []
+        for pending in pendings:
+            merge_vars = pending.merge_vars or {}
+            values = (merge_vars.get('OPTIN_TIME'), merge_vars.get('OPTIN_IP'))
+            if pending.user_id in existing:
+                updates.setdefault(values, []).append(pending.user_id)
+            else:
+                new.append(UserSubscription(user_id=pending.user_id, 
+                                            list_id=list_id, status=status,
+                                            optin_time=values[0], 
+                                            optin_ip=values[1]))
+        for (optin_time, optin_ip), ids in updates.items():
+            fields = {'status': status}
+            if optin_time:
+                fields['optin_time'] = optin_time
+            if optin_ip:
+                fields['optin_ip'] = optin_ip
+            UserSubscription.objects.for_list(list_id).filter(user__in=ids) \
+                                    .update(**fields)
+        if new:
+            UserSubscription.objects.bulk_create(new)
+        UserSubscription.objects.refresh_cached_statuses(
+            UserSubscription.objects.for_list(list_id).filter(user__in=user_ids))
+
+
 class PendingUserSubscription(models.Model):
     """
     Can be used as temporary storage for a user's subscription while the user is
-    pending internal (not MailChimp) activation or confirmaion.
+    pending internal (not MailChimp) activation or confirmaion. Use 
+    PendingUserSubscription.objects.flush() or the chimppending command to 
+    subscribe many pending users at once.
     """
     user = models.OneToOneField(User)
     merge_vars = SerializedDataField(null=True, blank=True)
     
+    objects = PendingUserSubscriptionManager()
+    
     class Meta:
         db_table = 'mailchimp_pending_user_subscription'
 
     def subscribe(self, **kwargs):
         """ Send the subscription to the MailChimp API. """
-        subscription, c = UserSubscription.objects.get_or_create(user=self.user)
+        subscription = UserSubscription.objects.get_for_user(self.user)
         if self.merge_vars:
             kwargs['merge_vars'] = self.merge_vars
         subscription.subscribe(**kwargs)
         
     def __unicode__(self):
         return self.user.email
-        
+
+
+class SyncCheckpoint(models.Model):
+    """
+    Records the progress of a chimpsync run after each batch so that an 
+    interrupted run can be resumed where it left off. 'last_pk' is the primary
+    key of the last UserSubscription processed. Only full runs, which go 
+    through the subscriptions in primary key order, can be resumed; 'mode' is
+    STALE for runs made with chimpsync --stale. 'stopped' is set if the run 
+    was stopped by its time budget. 'lists' holds the space separated list 
+    IDs the run was limited to, if any. 'report' holds the JSON report of 
+    runs made with chimpsync --report.
+    """
+    FULL = 'full'
+    STALE = 'stale'
+    MODES = (
+        (FULL, 'Full'),
+        (STALE, 'Stale'),
+    )
+
+    run_id = models.CharField(max_length=32, unique=True)
+    mode = models.CharField(max_length=10, choices=MODES, default=FULL)
+    last_pk = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    stopped = models.BooleanField(default=False)
+    lists = models.TextField(blank=True)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    report = models.TextField(blank=True)
+
+    class Meta:
+        db_table = 'mailchimp_sync_checkpoint'
+        ordering = ('-started',)
+
+    def get_lists(self):
+        """ The list IDs the run was limited to, or an empty list. """
+        return self.lists.split()
+
+    def record_error(self, user, message):
+        """ 
+        Store an error for a user that was skipped during this run. The 
+        checkpoint itself is not saved. 
+        """
+        self.errors += 1
+        return SyncError.objects.using(self._state.db).create(
+                                        checkpoint=self, user=user, 
+                                        email=user.email, message=message)
+
+    def __unicode__(self):
+        return self.run_id
+
+
+class SyncError(models.Model):
+    """ An error raised while syncing a single user during a chimpsync run. """
+    checkpoint = models.ForeignKey(SyncCheckpoint, related_name='sync_errors')
+    user = models.ForeignKey(User, null=True, blank=True, 
+                             on_delete=models.SET_NULL)
+    email = models.CharField(max_length=254, blank=True)
+    message = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'mailchimp_sync_error'
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.email, self.message)
+
+
+class MemberActivityManager(models.Manager):
+    MAX_EMAILS = 50
+
+    def ingest(self, queryset=None, list_id=None, chunk_size=500,
+               progress=None):
+        """
+        Store the activity of the members of the list ID, or the
+        MAILCHIMP_LIST_ID list if not provided, from listMemberActivity calls
+        of up to 50 email addresses each. The calls for a chunk of
+        subscriptions are made concurrently in the shared thread pool and the
+        new rows are inserted with bulk_create().
+
+        Only activity newer than the last stored for each user is inserted, so
+        that repeated runs are incremental. 'queryset' limits the
+        UserSubscription rows whose activity is fetched; by default those of
+        every subscribed, unsubscribed or cleaned member. 'progress' may be a
+        callable which is passed the number of rows created and the errors so
+        far after each chunk.
+
+        Returns the number of rows created and a list of the errors.
+        """
+        list_id = list_id or get_list_id()
+        if queryset is None:
+            queryset = UserSubscription.objects.filter(status__in=(
+                UserSubscription.SUBSCRIBED, UserSubscription.UNSUBSCRIBED,
+                UserSubscription.CLEANED))
+        queryset = queryset.filter(list_id=list_id).select_related('user') \
+                           .order_by('pk')
+        created = 0
+        errors = []
+        last_pk = 0
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                break
+            last_pk = chunk[-1].pk
+            users = dict((subscription.user.email.lower(), subscription.user_id)
+                         for subscription in chunk)
+            results = [call_async(self._fetch, list_id, emails)
+                       for emails in chunks(users.keys(), self.MAX_EMAILS)]
+            latest = dict(self.filter(list_id=list_id, user__in=users.values())
+                              .order_by().values_list('user')
+                              .annotate(last=models.Max('timestamp')))
+            rows = []
+            for activity, error in gather(*results):
+                if error is not None:
+                    errors.append(error)
+                    continue
+                for email, records in activity:
+                    user_id = users.get(email.lower())
+                    if user_id is None:
+                        continue
+                    for record in records:
+                        timestamp = parse_timestamp(record.get('timestamp'))
+                        if timestamp is None or (user_id in latest and
+                                                 timestamp <= latest[user_id]):
+                            continue
+                        rows.append(MemberActivity(user_id=user_id,
+                            list_id=list_id, action=record.get('action', ''),
+                            timestamp=timestamp,
+                            campaign_id=record.get('unique_id') or '',
+                            url=record.get('url') or ''))
+            if rows:
+                self.bulk_create(rows)
+                created += len(rows)
+            if progress:
+                progress(created, errors)
+        return created, errors
+
+    def _fetch(self, list_id, emails):
+        """
+        Make one listMemberActivity call. Runs in a worker thread. Returns a
+        list of (email, activity records) tuples and an exception. Addresses
+        the API returned an error for, eg. because they are not members, are
+        left out.
+        """
+        try:
+            response = get_client().listMemberActivity(id=list_id,
+                                                       email_address=emails)
+            raise_if_error(response)
+        except Exception as e:
+            return None, e
+        # the activity of each address is returned in the order requested
+        data = response.get('data', [])
+        if len(data) != len(emails):
+            return None, MailChimpTransportError("listMemberActivity returned "
+                            "%d results for %d email addresses" % (len(data),
+                                                                  len(emails)))
+        return [(email, records) for email, records in zip(emails, data)
+                if isinstance(records, list)], None
+
+
+class MemberActivity(models.Model):
+    """
+    An action of a member recorded by MailChimp, eg. an open or a click, as
+    returned by listMemberActivity. Use MemberActivity.objects.ingest() or the
+    chimpactivity command to store the activity of many members at once.
+    """
+    user = models.ForeignKey(User)
+    list_id = models.CharField(max_length=32)
+    action = models.CharField(max_length=20)
+    timestamp = models.DateTimeField(db_index=True)
+    campaign_id = models.CharField(max_length=20, blank=True)
+    url = models.CharField(max_length=255, blank=True)
+
+    objects = MemberActivityManager()
+
+    class Meta:
+        db_table = 'mailchimp_member_activity'
+        ordering = ('-timestamp',)
+
+    def __unicode__(self):
+        return u"%s %s" % (self.action, self.timestamp)
+
+
 @receiver(post_save, sender=User)
 def user_save_handler(sender, **kwargs):
     """ 
-    Create a UserSubscription object when a new User object is created.
+    Create a UserSubscription object for the MAILCHIMP_LIST_ID list when a new 
+    User object is created.
     """
     user = kwargs['instance']
     if kwargs['created']:
-        UserSubscription(user=user).save()
-    
+        UserSubscription(user=user, list_id=get_list_id()).save()
+
+@receiver(post_save, sender=UserSubscription)
+def subscription_save_handler(sender, **kwargs):
+    """ Write the status of a saved UserSubscription through to the cache. """
+    subscription = kwargs['instance']
+    cache.set(_status_cache_key(subscription.list_id, subscription.user_id),
+              subscription.status, _status_cache_timeout())
+
+@receiver(post_delete, sender=UserSubscription)
+def subscription_delete_handler(sender, **kwargs):
+    """ Remove the status of a deleted UserSubscription from the cache. """
+    subscription = kwargs['instance']
+    cache.delete(_status_cache_key(subscription.list_id, subscription.user_id))
@@ -0,0 +1,152 @@
+from django.contrib.auth.models import User
+from chimpusers.models import UserSubscription
+from chimpusers.utils import (get_list_id, get_client, raise_if_error,
+                              email_hash, chunks, get_error_emails)
+
+class Reconciliation(object):
+    """
+    Compares the local UserSubscription rows with the members of a MailChimp
+    list and computes the differences between the two sides.
+
+    Both sides are indexed by a 16 byte hash of the email address. Local rows
+    are read with an iterator and list members are read a page at a time, so
+    only the indexes and the differences are held in memory.
+
+    After run() the following attributes are available:
+
+    missing     pks of subscribed UserSubscription rows that are not
+                subscribed to the list.
+    orphans     email addresses subscribed to the list that do not belong
+                to an active user.
+    mismatched  (pk, email, local status, remote status) tuples for users
+                found on both sides with a different status.
+    """
+    REMOTE_STATUSES = ('subscribed', 'unsubscribed', 'cleaned')
+
+    def __init__(self, list_id=None, page_size=5000, batch_size=500):
+        self.list_id = list_id or get_list_id()
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.missing = []
+        self.orphans = []
+        self.mismatched = []
+        self.errors = []
+        self._client = None
+
+    def get_client(self):
+        if self._client is None:
+            self._client = get_client()
+        return self._client
+
+    def run(self):
+        """ Build both indexes and compute the differences. """
+        local = self._build_local_index()
+        seen = set()
+        for status in self.REMOTE_STATUSES:
+            remote_status = UserSubscription.API_STATUSES[status]
+            for email in self._iter_members(status):
+                key = email_hash(email)
+                seen.add(key)
+                try:
+                    pk, local_status = local[key]
+                except KeyError:
+                    if status == 'subscribed':
+                        self.orphans.append(email)
+                    continue
+                if local_status != remote_status:
+                    self.mismatched.append((pk, email, local_status,
+                                            remote_status))
+        for key, (pk, local_status) in local.iteritems():
+            if local_status == UserSubscription.SUBSCRIBED and key not in seen:
+                self.missing.append(pk)
+        return self
+
+    def apply(self, prune=False, double_optin=True):
+        """
+        Converge both sides using only the calls required by the differences.
+
+        Mismatched statuses are pulled into the local rows without any API
+        calls. Missing subscribers are pushed with listBatchSubscribe; unless
+        'double_optin' is False they are sent a confirmation email and their
+        local rows become pending, as MailChimp has no record of their 
+        consent. If 'prune' is True the orphaned members are removed from the
+        list with listBatchUnsubscribe.
+
+        Returns the number of API calls made. Errors reported by the batch
+        calls are collected in the 'errors' attribute.
+        """
+        calls = 0
+        by_status = {}
+        for pk, email, local_status, remote_status in self.mismatched:
+            by_status.setdefault(remote_status, []).append(pk)
+        for status, pks in by_status.items():
+            for chunk in chunks(pks, self.batch_size):
+                changed = UserSubscription.objects.filter(pk__in=chunk)
+                changed.update(status=status)
+                UserSubscription.objects.refresh_cached_statuses(changed)
+
+        ms = self.get_client()
+        for chunk in chunks(self.missing, self.batch_size):
+            subscriptions = list(UserSubscription.objects.filter(pk__in=chunk)
+                                                 .select_related('user'))
+            batch = [{'EMAIL': subscription.user.email, 
+                      'FNAME': subscription.user.first_name,
+                      'LNAME': subscription.user.last_name}
+                     for subscription in subscriptions]
+            response = ms.listBatchSubscribe(id=self.list_id, batch=batch,
+                                             double_optin=double_optin,
+                                             update_existing=True,
+                                             replace_interests=False)
+            raise_if_error(response)
+            self.errors.extend(response.get('errors', []))
+            calls += 1
+            if double_optin:
+                failed = get_error_emails(response)
+                pending = UserSubscription.objects.filter(pk__in=[
+                            subscription.pk for subscription in subscriptions
+                            if subscription.user.email.lower() not in failed])
+                pending.update(status=UserSubscription.PENDING)
+                UserSubscription.objects.refresh_cached_statuses(pending)
+
+        if prune:
+            for chunk in chunks(self.orphans, self.batch_size):
+                response = ms.listBatchUnsubscribe(id=self.list_id,
+                                                   emails=chunk,
+                                                   send_goodbye=False,
+                                                   send_notify=False)
+                raise_if_error(response)
+                self.errors.extend(response.get('errors', []))
+                calls += 1
+        return calls
+
+    def missing_emails(self):
+        """ Yields the email addresses of the missing subscribers. """
+        for chunk in chunks(self.missing, self.batch_size):
+            users = User.objects.filter(usersubscription__in=chunk)
+            for email in users.values_list('email', flat=True):
+                yield email
+
+    def _build_local_index(self):
+        local = {}
+        rows = UserSubscription.objects.for_list(self.list_id) \
+                                       .filter(user__is_active=True) \
+                                       .values_list('pk', 'user__email',
+                                                    'status')
+        for pk, email, status in rows.iterator():
+            local[email_hash(email)] = (pk, status)
+        return local
+
+    def _iter_members(self, status):
+        """ Page through the list members with the given status. """
+        ms = self.get_client()
+        page = 0
+        while True:
+            response = ms.listMembers(id=self.list_id, status=status,
+                                      start=page, limit=self.page_size)
+            raise_if_error(response)
+            for member in response['data']:
+                yield member['email']
+            if len(response['data']) < self.page_size:
+                return
+            page += 1
+
@@ -0,0 +1,160 @@
+"""
+Schedules the API calls of every process against the shared rate budget of
+MAILCHIMP_CALLS_PER_SECOND, giving interactive calls (eg. subscribe() during
+signup) priority over bulk jobs such as chimpsync.
+
+Calls are interactive unless made within priority(BULK), which the bulk
+management commands and admin actions do. Bulk calls may only use
+MAILCHIMP_BULK_SHARE (default 0.8) of the budget, less the number of
+interactive calls made in the previous second, and wait for the next second
+otherwise. The calls of each second are counted in Django's cache, so the
+budget is shared by every process using the same cache backend (eg.
+memcached); with a per-process cache it is only enforced per process.
+
+deadline() limits the total time of the calls made within it, eg. by a view
+that makes several calls. The remaining time is passed to the transport as
+the timeout of each call, and MailChimpTimeout is raised once it is used up.
+The priority class and the deadline follow calls made in the thread pools.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from django.core.cache import cache
+from chimpusers.exceptions import MailChimpTimeout
+
+INTERACTIVE = 0
+BULK = 1
+
+_local = threading.local()
+
+def get_priority():
+    """ Get the priority class of the calls made by the current thread. """
+    return getattr(_local, 'priority', INTERACTIVE)
+
+@contextmanager
+def priority(level):
+    """ Make the calls of the current thread with the given priority class. """
+    previous = get_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+def get_deadline():
+    """
+    Get the time (as returned by time.time()) by which the calls of the
+    current thread must complete, or None.
+    """
+    return getattr(_local, 'deadline', None)
+
+@contextmanager
+def deadline(seconds):
+    """
+    Make the calls of the current thread within the block complete within
+    'seconds' in total. A nested deadline cannot extend an outer one.
+    """
+    previous = get_deadline()
+    end = time.time() + seconds
+    if previous is not None:
+        end = min(end, previous)
+    _local.deadline = end
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+def remaining_time():
+    """ 
+    Get the seconds left until the deadline of the current thread, or None.
+    Raises MailChimpTimeout if the deadline has passed.
+    """
+    end = get_deadline()
+    if end is None:
+        return None
+    remaining = end - time.time()
+    if remaining <= 0:
+        raise MailChimpTimeout("The deadline of the operation has passed.")
+    return remaining
+
+def with_call_context(func):
+    """
+    Wrap 'func' so that it runs with the priority class and the deadline of
+    the current thread, eg. in a worker thread of a pool.
+    """
+    level = get_priority()
+    end = get_deadline()
+    def wrapper(*args, **kwargs):
+        previous = get_deadline()
+        _local.deadline = end
+        try:
+            with priority(level):
+                return func(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return wrapper
+
+
+class Scheduler(object):
+    """
+    Admits up to 'rate' calls per second across processes, of which bulk calls
+    may use 'bulk_share'.
+    """
+    KEY_PREFIX = 'chimpusers:calls'
+    TIMEOUT = 5
+
+    def __init__(self, rate, bulk_share=0.8):
+        self.rate = max(1, int(rate))
+        self.bulk_rate = max(1, int(self.rate * bulk_share))
+
+    def acquire(self, level=None):
+        """ 
+        Block until a call of the priority class 'level' is allowed. Raises 
+        MailChimpTimeout if that would be after the current thread's deadline.
+        """
+        if level is None:
+            level = get_priority()
+        if level == INTERACTIVE:
+            self._incr(self._key('interactive', int(time.time())))
+        while True:
+            now = time.time()
+            window = int(now)
+            if level == INTERACTIVE:
+                limit = self.rate
+            else:
+                # calls of this second are counted below, keep room for
+                # as many interactive calls as were made the second before
+                recent = self._get(self._key('interactive', window - 1))
+                limit = self.bulk_rate - recent
+            if limit > 0:
+                key = self._key('all', window)
+                count = self._incr(key)
+                if count is None or count <= limit:
+                    return
+                self._decr(key)
+            end = get_deadline()
+            if end is not None and window + 1 >= end:
+                raise MailChimpTimeout("The rate budget is used up until "
+                                       "after the deadline.")
+            time.sleep(window + 1 - now)
+
+    def _key(self, name, window):
+        return '%s:%s:%d' % (self.KEY_PREFIX, name, window)
+
+    def _get(self, key):
+        return cache.get(key) or 0
+
+    def _incr(self, key):
+        """ Increment a counter, or return None if the cache cannot. """
+        cache.add(key, 0, self.TIMEOUT)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # evicted, or a cache backend that does not store anything
+            return None
+
+    def _decr(self, key):
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
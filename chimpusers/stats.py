@@ -0,0 +1,145 @@
+"""
+Cached aggregates of the UserSubscription table, so that summaries and the
+admin do not count millions of rows on every page load.
+
+The counts are cached for MAILCHIMP_STATS_CACHE_TIMEOUT seconds (default one
+hour) and refreshed by refresh_counts(), which chimpsync, chimpimport and
+chimpreconcile call when they have changed statuses.
+"""
+import hashlib
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count
+from django.db.models.query import QuerySet
+from django.utils import timezone
+from chimpusers.models import UserSubscription
+from chimpusers.utils import get_list_id
+
+OPTIN_DAYS = 30
+
+def _timeout():
+    return getattr(settings, 'MAILCHIMP_STATS_CACHE_TIMEOUT', 60 * 60)
+
+def get_status_counts(list_id=None, refresh=False):
+    """
+    Get the number of subscriptions to the list ID, or the MAILCHIMP_LIST_ID
+    list if not provided, per status as a dict. Computed with one query when
+    not cached or if 'refresh' is True.
+    """
+    list_id = list_id or get_list_id()
+    key = 'chimpusers:stats:status:%s' % list_id
+    counts = None if refresh else cache.get(key)
+    if counts is None:
+        counts = dict((status, 0) for status, label in UserSubscription.CHOICES)
+        counts.update(UserSubscription.objects.for_list(list_id).order_by()
+                          .values_list('status').annotate(count=Count('pk')))
+        cache.set(key, counts, _timeout())
+    return counts
+
+def get_optin_counts(list_id=None, days=OPTIN_DAYS, refresh=False):
+    """
+    Get the number of opt-ins to the list ID, or the MAILCHIMP_LIST_ID list
+    if not provided, per day for the last 'days' days as a list of (date,
+    count) tuples, oldest first. Days without opt-ins have a count of 0.
+    """
+    list_id = list_id or get_list_id()
+    key = 'chimpusers:stats:optin:%s:%d' % (list_id, days)
+    counts = None if refresh else cache.get(key)
+    if counts is None:
+        since = timezone.now().replace(hour=0, minute=0, second=0,
+                                       microsecond=0) - timedelta(days - 1)
+        start = since.date()
+        queryset = UserSubscription.objects.for_list(list_id).order_by() \
+                       .filter(optin_time__gte=since)
+        connection = connections[queryset.db]
+        column = '%s.%s' % (connection.ops.quote_name(
+                                UserSubscription._meta.db_table),
+                            connection.ops.quote_name('optin_time'))
+        rows = queryset.extra(select={
+                    'day': connection.ops.date_trunc_sql('day', column)}) \
+                       .values_list('day').annotate(count=Count('pk'))
+        by_day = {}
+        for day, count in rows:
+            if isinstance(day, basestring):
+                day = datetime.strptime(day[:10], '%Y-%m-%d')
+            if isinstance(day, datetime):
+                day = day.date()
+            by_day[day] = by_day.get(day, 0) + count
+        counts = []
+        for i in range(days):
+            day = start + timedelta(days=i)
+            counts.append((day, by_day.get(day, 0)))
+        cache.set(key, counts, _timeout())
+    return counts
+
+def get_list_ids(refresh=False):
+    """
+    Get the sorted IDs of the lists that have subscriptions, always including
+    the MAILCHIMP_LIST_ID list. Computed with one query when not cached or if
+    'refresh' is True.
+    """
+    key = 'chimpusers:stats:lists'
+    list_ids = None if refresh else cache.get(key)
+    if list_ids is None:
+        list_ids = set(UserSubscription.objects.order_by()
+                           .values_list('list_id', flat=True).distinct())
+        list_ids.add(get_list_id())
+        list_ids = sorted(list_ids)
+        cache.set(key, list_ids, _timeout())
+    return list_ids
+
+def refresh_counts(list_id=None):
+    """ 
+    Recompute the cached counts of a list, and the list IDs if the list is 
+    new. 
+    """
+    if (list_id or get_list_id()) not in get_list_ids():
+        get_list_ids(refresh=True)
+    get_status_counts(list_id, refresh=True)
+    get_optin_counts(list_id, refresh=True)
+
+def estimated_count(queryset):
+    """
+    Estimate the number of rows in the table of 'queryset' from the planner
+    statistics on PostgreSQL, which needs no scan. Small tables, and other
+    databases, are counted exactly and the count is cached.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [queryset.model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] >= 1000:
+            return int(row[0])
+    return _cached_count(queryset)
+
+def _cached_count(queryset):
+    """ Count the rows of 'queryset', caching the count by its SQL. """
+    sql, params = queryset.query.sql_with_params()
+    key = 'chimpusers:stats:count:%s' % hashlib.md5(
+                                        repr((queryset.db, sql, params))
+                                        ).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = QuerySet.count(queryset)
+        cache.set(key, count, _timeout())
+    return count
+
+
+class EstimatedCountQuerySet(QuerySet):
+    """
+    A QuerySet whose count() is estimated when it has no filters and cached
+    otherwise, for the admin changelist, whose paginator and result counts
+    would each count the whole table on every page load.
+    """
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if self.query.low_mark or self.query.high_mark is not None:
+            return super(EstimatedCountQuerySet, self).count()
+        if not self.query.where:
+            return estimated_count(self)
+        return _cached_count(self)
@@ -0,0 +1,282 @@
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import F
+from django.utils import timezone
+from django.contrib.auth.models import User
+from chimpusers.exceptions import MailChimpError
+from chimpusers.models import UserSubscription, InterestGrouping, \
+                              MemberInterests
+from chimpusers.scheduler import with_call_context
+from chimpusers.utils import (get_list_id, get_client, atomic,
+                              raise_if_error, chunks)
+
+class SyncEngine(object):
+    """
+    Syncs UserSubscription rows with the MailChimp API in batches.
+
+    The subscriptions in a batch are grouped by list so that each
+    listMemberInfo call targets a single list with up to 50 email addresses.
+    The calls for different lists are made concurrently by a pool of up to
+    MAILCHIMP_MAX_CONNECTIONS (default 10) threads, all drawing from the
+    shared rate budget. Database access only happens in the calling thread.
+    
+    The stored interest groupings of each list are read once per engine, and
+    only refreshed when a member is in a grouping that is not stored. The
+    interest groups of each member are stored locally.
+    """
+    MAX_EMAILS = 50
+
+    def __init__(self, max_connections=None, using=None, read_using=None):
+        if max_connections is None:
+            max_connections = getattr(settings, 'MAILCHIMP_MAX_CONNECTIONS',
+                                      10)
+        self.max_connections = max_connections
+        self.using = using or router.db_for_write(UserSubscription)
+        self.read_using = read_using or self.using
+        self._pool = None
+        self._client = None
+        self._groupings = {}
+
+    def get_client(self):
+        if self._client is None:
+            self._client = get_client()
+        return self._client
+
+    def close(self):
+        """ Shut down the worker threads. """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def set_statement_timeout(self, milliseconds):
+        """
+        Limit the duration of every statement run on the connections of the
+        engine's database aliases. Only supported on PostgreSQL; raises
+        NotImplementedError for other databases.
+        """
+        for alias in set([self.using, self.read_using]):
+            connection = connections[alias]
+            if connection.vendor != 'postgresql':
+                raise NotImplementedError("Statement timeouts are not "
+                                          "supported for %s" % connection.vendor)
+            connection.cursor().execute('SET statement_timeout = %s',
+                                        [int(milliseconds)])
+
+    def get_subscriptions(self, lists=None):
+        """
+        The UserSubscription rows of the active users, in primary key order, 
+        read from the 'read_using' alias. 'lists' optionally limits them to 
+        the given list IDs.
+        """
+        subscriptions = UserSubscription.objects.using(self.read_using) \
+                                        .filter(user__is_active=True) \
+                                        .select_related('user') \
+                                        .order_by('pk')
+        if lists:
+            subscriptions = subscriptions.filter(list_id__in=lists)
+        return subscriptions
+
+    def list_exists(self, list_id):
+        """
+        Returns True if 'list_id' is the MAILCHIMP_LIST_ID list or one of the
+        lists of the account, checked with a lists API call.
+        """
+        if list_id == get_list_id():
+            return True
+        response = self.get_client().lists(filters={'list_id': list_id})
+        raise_if_error(response)
+        return bool(response.get('total'))
+
+    def ensure_subscriptions(self, list_id=None, batch_size=1000):
+        """
+        Create the missing UserSubscription rows of every active user for the
+        given list ID, or the MAILCHIMP_LIST_ID list if not provided.
+        Returns the number of rows created. Raises MailChimpError if the list
+        does not exist.
+        """
+        list_id = list_id or get_list_id()
+        if not self.list_exists(list_id):
+            raise MailChimpError("Invalid MailChimp List ID: %s" % list_id, 
+                                 200)
+        # read from the primary, a lagging replica would cause duplicates
+        users = User.objects.using(self.using).filter(is_active=True) \
+                            .exclude(usersubscription__list_id=list_id) \
+                            .values_list('pk', flat=True)
+        created = 0
+        for chunk in chunks(users.iterator(), batch_size):
+            UserSubscription.objects.using(self.using).bulk_create(
+                [UserSubscription(user_id=pk, list_id=list_id) for pk in chunk])
+            created += len(chunk)
+        return created
+
+    def sync_batch(self, subscriptions):
+        """
+        Sync a batch of UserSubscription instances, saving those that changed.
+
+        Returns a list of (subscription, error) tuples where 'error' is None
+        if the subscription was synced and the exception otherwise.
+        """
+        results = []
+        changed = []
+        unchanged = []
+        interests = []
+        for subscription, data, error in self.fetch_batch(subscriptions):
+            if error is not None:
+                results.append((subscription, error))
+                continue
+            if subscription.set_member_info(data):
+                changed.append(subscription)
+            else:
+                unchanged.append(subscription)
+            if data and 'merges' in data:
+                interests.append((subscription, 
+                                  data['merges'].get('GROUPINGS', [])))
+            results.append((subscription, None))
+        self.save_changed(changed, unchanged)
+        masks = [(subscription, subscription.get_interest_masks(groupings,
+                    self.get_known_groupings(subscription.list_id, groupings)))
+                 for subscription, groupings in interests]
+        MemberInterests.objects.db_manager(self.using).store(masks)
+        return results
+
+    def fetch_batch(self, subscriptions):
+        """
+        Get the member info of a batch of UserSubscription instances without
+        changing them. Returns a list of (subscription, data, error) tuples 
+        where 'data' is the member's listMemberInfo data, or None if the user
+        is not a member, and 'error' the exception if the call failed.
+        """
+        calls = []
+        by_list = {}
+        for subscription in subscriptions:
+            by_list.setdefault(subscription.list_id, []).append(subscription)
+        for list_id, members in by_list.items():
+            for chunk in chunks(members, self.MAX_EMAILS):
+                calls.append((list_id, chunk))
+
+        # the users are loaded here, the workers must not touch the database
+        requests = [(list_id, [subscription.user.email 
+                               for subscription in chunk])
+                    for list_id, chunk in calls]
+        if len(calls) > 1 and self.max_connections > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_connections)
+            responses = self._pool.map(with_call_context(self._fetch), 
+                                       requests)
+        else:
+            responses = map(self._fetch, requests)
+
+        results = []
+        for (list_id, chunk), (members, error) in zip(calls, responses):
+            for subscription in chunk:
+                if error is not None:
+                    results.append((subscription, None, error))
+                else:
+                    data = members.get(subscription.user.email.lower())
+                    results.append((subscription, data, None))
+        return results
+
+    def save_changed(self, subscriptions, synced=()):
+        """
+        Write the fields set by set_member_info() of the changed 
+        subscriptions to the 'using' alias in one transaction, with one
+        UPDATE per distinct set of values, and write their statuses through to
+        the cache. post_save is not sent for these rows. The last_synced time
+        of the unchanged subscriptions in 'synced' is written as well.
+        """
+        if not subscriptions and not synced:
+            return
+        now = timezone.now()
+        updates = {}
+        for subscription in subscriptions:
+            values = (subscription.status, subscription.optin_time,
+                      subscription.optin_ip, subscription.merge_fingerprint)
+            updates.setdefault(values, []).append(subscription.pk)
+        manager = UserSubscription.objects.db_manager(self.using)
+        with atomic(using=self.using):
+            for (status, optin_time, optin_ip, fingerprint), pks in \
+                    updates.items():
+                for chunk in chunks(pks, 500):
+                    manager.filter(pk__in=chunk).update(status=status,
+                        optin_time=optin_time, optin_ip=optin_ip,
+                        merge_fingerprint=fingerprint, last_synced=now,
+                        change_count=F('change_count') + 1)
+            for chunk in chunks([subscription.pk for subscription in synced],
+                                500):
+                manager.filter(pk__in=chunk).update(last_synced=now)
+        for chunk in chunks([subscription.pk for subscription in subscriptions],
+                            500):
+            manager.refresh_cached_statuses(manager.filter(pk__in=chunk))
+
+    def select_stale(self, limit, lists=None):
+        """
+        Choose up to 'limit' subscriptions that most need syncing, in order:
+        PENDING members, which usually change soon, subscriptions never
+        synced, subscriptions that changed before, most often first (half of
+        what remains), and finally the least recently synced. Returns a list
+        of primary keys.
+        """
+        subscriptions = self.get_subscriptions(lists).order_by()
+        never = subscriptions.filter(last_synced__isnull=True)
+        synced = subscriptions.filter(last_synced__isnull=False) \
+                              .order_by('last_synced')
+        tiers = [
+            (never.filter(status=UserSubscription.PENDING), limit),
+            (synced.filter(status=UserSubscription.PENDING), limit),
+            (never, limit),
+            (synced.filter(change_count__gt=0).order_by('-change_count',
+                                                        'last_synced'), None),
+            (synced, limit),
+        ]
+        chosen = []
+        seen = set()
+        for queryset, size in tiers:
+            remaining = limit - len(chosen)
+            if remaining <= 0:
+                break
+            if size is None:
+                size = (remaining + 1) // 2
+            size = min(size, remaining)
+            # the earlier tiers may overlap this one
+            pks = queryset.values_list('pk', flat=True)[:size + len(seen)]
+            for pk in [pk for pk in pks if pk not in seen][:size]:
+                seen.add(pk)
+                chosen.append(pk)
+        return chosen
+
+    def get_known_groupings(self, list_id, groupings=()):
+        """ 
+        Get the stored interest groupings of a list, cached by the engine. 
+        They are refreshed from the API if one of 'groupings' is missing, see
+        InterestGrouping.objects.get_known_for().
+        """
+        known = self._groupings.get(list_id)
+        if known is None or [grouping for grouping in groupings
+                             if grouping.get('id') not in known and
+                                grouping.get('name') not in known]:
+            known = InterestGrouping.objects.db_manager(self.using) \
+                                            .get_known_for(groupings, list_id)
+            self._groupings[list_id] = known
+        return known
+
+    def _fetch(self, call):
+        """
+        Make one listMemberInfo call for a (list ID, email addresses) tuple.
+        Runs in a worker thread. Returns a dict mapping lowercase email 
+        addresses to member data and an exception.
+        """
+        list_id, emails = call
+        try:
+            response = self.get_client().listMemberInfo(
+                                            id=list_id, email_address=emails)
+            raise_if_error(response)
+        except Exception as e:
+            return None, e
+        members = {}
+        for data in response.get('data', []):
+            email = data.get('email') or data.get('email_address')
+            if email:
+                members[email.lower()] = data
+        return members, None
@@ -0,0 +1,25 @@
+from django import template
+from chimpusers.models import UserSubscription
+
+register = template.Library()
+
+@register.filter
+def with_subscriptions(users, list_id=None):
+    """
+    Load the subscriptions of a list of users with a single query so that
+    is_subscribed can be used on each of them without further queries.
+    
+        {% for member in members|with_subscriptions %}
+            {% if member|is_subscribed %}...{% endif %}
+        {% endfor %}
+    """
+    return UserSubscription.objects.attach_to(users, list_id)
+
+@register.filter
+def is_subscribed(user, list_id=None):
+    """ 
+    True if the user is subscribed to the list ID, or the MAILCHIMP_LIST_ID 
+    list if not provided.
+    """
+    subscription = UserSubscription.objects.get_memoized(user, list_id)
+    return bool(subscription and subscription.is_subscribed())
@@ -1,14 +1,46 @@
+import csv
+import gzip
+import os
+import tempfile
+import time
 from datetime import datetime
+from StringIO import StringIO
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
 from django.utils import unittest
 from django.test import Client, TestCase
+from django.core.management import call_command
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.forms.widgets import RadioSelect, Select, CheckboxInput
 from mailsnake import MailSnake
 from chimpusers.utils import get_list_id
-from chimpusers.models import UserSubscription, PendingUserSubscription
+from django.core.cache import cache
+from chimpusers.models import UserSubscription, PendingUserSubscription, \
+                              MemberInterests, MemberActivity, \
+                              SyncCheckpoint
 from chimpusers.exceptions import MailChimpError
 from chimpusers.forms import groups_form_factory
+from chimpusers.batching import OperationBatch
+from chimpusers.sync import SyncEngine
+from chimpusers.reconcile import Reconciliation
+from chimpusers.groups import GroupingIndex, parse_groups, serialize_groups
+from chimpusers.client import (MailChimpClient, Transport, RecordingTransport,
+                               ReplayTransport, HTTPTransport)
+from chimpusers.exceptions import MailChimpTransportError, MailChimpTimeout
+import chimpusers.scheduler
+import chimpusers.utils
+from chimpusers.scheduler import (Scheduler, priority, get_priority, 
+                                  deadline, BULK, INTERACTIVE)
+from chimpusers.utils import call_async, gather
+from chimpusers import memo
+from chimpusers.templatetags.chimpusers_tags import (with_subscriptions, 
+                                                     is_subscribed)
+from chimpusers.estimate import wilson_interval
+from chimpusers.stats import get_status_counts, get_list_ids, \
+                             refresh_counts, EstimatedCountQuerySet
 
 def get_admin_user():
     """ 
@@ -204,8 +236,938 @@ class FormsTestCase(TestCase):
         for field in form:
             self.assertTrue(isinstance(field.field.widget, Select), 
                             "Field should be represented by a select box.")
-            
+
+
+class GroupsTestCase(unittest.TestCase):
+    """ Test case for parsing and indexing interest groups. """
+    def test_parse_groups(self):
+        """ Test splitting group strings with escaped commas. """
+        self.assertEqual(parse_groups("Option 1, Option 2"), 
+                         ["Option 1", "Option 2"])
+        self.assertEqual(parse_groups("Sales\\, Deals,News"), 
+                         ["Sales, Deals", "News"])
+        self.assertEqual(parse_groups(""), [])
+        names = ["A, B", "C"]
+        self.assertEqual(parse_groups(serialize_groups(names)), names)
+        
+    def test_grouping_index(self):
+        """ Test that overlapping group names are matched exactly. """
+        index = GroupingIndex({'id': 1, 'name': 'Interests', 
+                               'form_field': 'checkboxes',
+                               'groups': [{'bit': '1', 'name': 'News'},
+                                          {'bit': '2', 'name': 'News Digest'}]})
+        self.assertEqual(index.parse("News Digest"), set(["News Digest"]))
+        self.assertEqual(index.names_for_keys(['mailchimp_group_2', 
+                                               'mailchimp_group_1']),
+                         ['News', 'News Digest'])
+
+
+class EstimateTestCase(unittest.TestCase):
+    """ Test case for the confidence intervals of drift estimates. """
+    def test_wilson_interval(self):
+        """ Test the interval against known values. """
+        low, high = wilson_interval(10, 100)
+        self.assertAlmostEqual(low, 0.0552, 4)
+        self.assertAlmostEqual(high, 0.1744, 4)
+        low, high = wilson_interval(0, 50)
+        self.assertEqual(low, 0.0)
+        self.assertTrue(0 < high < 0.08)
+        self.assertEqual(wilson_interval(0, 0), (0.0, 1.0))
+
+
+class StatsTestCase(TestCase):
+    """ Test case for the cached subscription counts. """
+    def setUp(self):
+        for i in range(3):
+            User.objects.create_user('stats%d' % i, 'stats%d@example.com' % i)
+        self.subscriptions = UserSubscription.objects.for_list().filter(
+                                            user__username__startswith='stats')
+        self.subscriptions.update(status=UserSubscription.SUBSCRIBED)
+    
+    def test_status_counts(self):
+        """ Test that counts are cached until refreshed. """
+        counts = get_status_counts(refresh=True)
+        subscribed = counts[UserSubscription.SUBSCRIBED]
+        self.assertTrue(subscribed >= 3)
+        self.subscriptions.update(status=UserSubscription.UNSUBSCRIBED)
+        self.assertEqual(get_status_counts()[UserSubscription.SUBSCRIBED],
+                         subscribed)
+        counts = get_status_counts(refresh=True)
+        self.assertEqual(counts[UserSubscription.SUBSCRIBED], subscribed - 3)
+    
+    def test_list_ids(self):
+        """ Test that the list IDs are cached and new lists added. """
+        cache.clear()
+        self.assertEqual(get_list_ids(), [get_list_id()])
+        UserSubscription.objects.get_for_user(User.objects.all()[0], 
+                                              list_id='other')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_list_ids(), [get_list_id()])
+        refresh_counts('other')
+        self.assertEqual(get_list_ids(), sorted([get_list_id(), 'other']))
+    
+    def test_estimated_count(self):
+        """ Test that filtered counts are exact and then cached. """
+        queryset = self.subscriptions._clone(klass=EstimatedCountQuerySet)
+        self.assertEqual(queryset.count(), 3)
+        self.subscriptions[0].delete()
+        self.assertEqual(queryset.all().count(), 3)
+        self.assertEqual(self.subscriptions.count(), 2)
+
+
+class CountingTransport(Transport):
+    """ Answers every request with the number of requests made so far. """
+    def __init__(self):
+        self.count = 0
+        self.timeouts = []
+    
+    def request(self, host, method, params, timeout=None):
+        self.count += 1
+        self.timeouts.append(timeout)
+        return {'method': method, 'count': self.count}
+
+class FakeChimpTransport(Transport):
+    """ 
+    Answers the API methods used by this app from an in-memory list, for 
+    tests without a network. 'members' maps (list ID, lowercase email) to the
+    member info and 'calls' records the methods called.
+    """
+    GROUPINGS = [{'id': 1, 'name': 'Interests', 'form_field': 'checkboxes',
+                  'groups': [{'bit': '1', 'name': 'News'},
+                             {'bit': '2', 'name': 'Deals, Promos'}]}]
+    
+    def __init__(self):
+        self.members = {}
+        self.calls = []
+    
+    def request(self, host, method, params, timeout=None):
+        self.calls.append(method)
+        return getattr(self, method)(params)
+    
+    def add_member(self, list_id, email, status, merge_vars=None):
+        member = self.members.setdefault((list_id, email.lower()), {
+            'email': email, 'status': status, 'ip_opt': None, 
+            'timestamp': '2012-01-01 00:00:00', 'email_type': 'html',
+            'merges': {'GROUPINGS': []}})
+        member['status'] = status
+        merge_vars = merge_vars or {}
+        if 'GROUPINGS' in merge_vars:
+            member['merges']['GROUPINGS'] = [dict(grouping, id=1) 
+                                    for grouping in merge_vars['GROUPINGS']]
+        if merge_vars.get('OPTIN_IP'):
+            member['ip_opt'] = merge_vars['OPTIN_IP']
+        return member
+    
+    def lists(self, params):
+        ids = set(list_id for list_id, email in self.members)
+        ids.add(settings.MAILCHIMP_LIST_ID)
+        wanted = params.get('filters', {}).get('list_id')
+        data = [{'id': list_id} for list_id in sorted(ids) 
+                if wanted in (None, list_id)]
+        return {'total': len(data), 'data': data}
+    
+    def listSubscribe(self, params):
+        status = 'pending'
+        if params.get('double_optin') is False:
+            status = 'subscribed'
+        self.add_member(params['id'], params['email_address'], status, 
+                        params.get('merge_vars'))
+        return True
+    
+    def listUpdateMember(self, params):
+        key = (params['id'], params['email_address'].lower())
+        if key not in self.members:
+            return {'error': 'Not a list member', 'code': 232}
+        self.add_member(params['id'], params['email_address'], 
+                        self.members[key]['status'], params.get('merge_vars'))
+        return True
+    
+    def listUnsubscribe(self, params):
+        key = (params['id'], params['email_address'].lower())
+        if key not in self.members:
+            return {'error': 'Not a list member', 'code': 232}
+        if params.get('delete_member'):
+            del self.members[key]
+        else:
+            self.members[key]['status'] = 'unsubscribed'
+        return True
+    
+    def listBatchSubscribe(self, params):
+        status = 'pending'
+        if params.get('double_optin') is False:
+            status = 'subscribed'
+        errors = []
+        for row in params['batch']:
+            if 'invalid' in row['EMAIL']:
+                errors.append({'code': 502, 'message': 'Invalid Email', 
+                               'email': row['EMAIL']})
+            else:
+                self.add_member(params['id'], row['EMAIL'], status, row)
+        return {'add_count': len(params['batch']) - len(errors), 
+                'update_count': 0, 'error_count': len(errors), 
+                'errors': errors}
+    
+    def listBatchUnsubscribe(self, params):
+        for email in params['emails']:
+            key = (params['id'], email.lower())
+            if params.get('delete_member'):
+                self.members.pop(key, None)
+            elif key in self.members:
+                self.members[key]['status'] = 'unsubscribed'
+        return {'success_count': len(params['emails']), 'error_count': 0,
+                'errors': []}
+    
+    def listMemberInfo(self, params):
+        emails = params['email_address']
+        if isinstance(emails, basestring):
+            emails = [emails]
+        data = []
+        for email in emails:
+            member = self.members.get((params['id'], email.lower()))
+            if member is None:
+                data.append({'email_address': email, 'code': 232,
+                             'error': 'Not a list member'})
+            else:
+                data.append(dict(member))
+        found = len([member for member in data if 'error' not in member])
+        return {'success': found, 'errors': len(data) - found, 'data': data}
+    
+    def listMembers(self, params):
+        members = sorted([member for (list_id, email), member in 
+                          self.members.items() if list_id == params['id'] 
+                          and member['status'] == params['status']],
+                         key=lambda member: member['email'])
+        start = params.get('start', 0) * params.get('limit', 100)
+        page = members[start:start + params.get('limit', 100)]
+        return {'total': len(members), 
+                'data': [{'email': member['email'], 
+                          'timestamp': member['timestamp']} 
+                         for member in page]}
+    
+    def listInterestGroupings(self, params):
+        return self.GROUPINGS
+    
+    def listMemberActivity(self, params):
+        data = []
+        for email in params['email_address']:
+            member = self.members.get((params['id'], email.lower()))
+            if member is None:
+                data.append({'email': email, 'code': 232,
+                             'error': 'Not a list member'})
+            else:
+                data.append(member.get('activity', []))
+        found = len([records for records in data if 'error' not in records])
+        return {'success': found, 'errors': len(data) - found, 'data': data}
+
+
+class FakeChimpTestCase(TestCase):
+    """ 
+    Makes the API calls of the app with a FakeChimpTransport, available as
+    'self.chimp'.
+    """
+    def setUp(self):
+        self.chimp = FakeChimpTransport()
+        self.list_id = get_list_id()
+        chimpusers.utils._client = MailChimpClient('fake-us1', self.chimp)
+        cache.clear()
+    
+    def tearDown(self):
+        chimpusers.utils._client = None
+    
+    def create_user(self, name, status=UserSubscription.UNKNOWN):
+        user = User.objects.create_user(name, '%s@example.com' % name)
+        UserSubscription.objects.filter(user=user).update(status=status)
+        return user
+    
+    def get_subscription(self, user):
+        return UserSubscription.objects.get(user=user, list_id=self.list_id)
+
+
+class InterestsTestCase(FakeChimpTestCase):
+    """ Test case for the locally stored interest groups. """
+    def test_sync_interests(self):
+        """ Test that sync() stores the groups without a prior refresh. """
+        user = self.create_user('interests')
+        self.chimp.add_member(self.list_id, user.email, 'subscribed', 
+            {'GROUPINGS': [{'name': 'Interests', 'groups': 'News'}]})
+        subscription = self.get_subscription(user)
+        subscription.sync()
+        self.assertEqual(MemberInterests.objects.get(
+                            subscription=subscription).get_group_names(), 
+                         ['News'])
+        self.assertEqual(list(UserSubscription.objects.in_group('News')), 
+                         [subscription])
+        self.assertEqual(list(UserSubscription.objects.in_group(
+                            'Deals, Promos')), [])
+        self.assertEqual(MemberInterests.objects.in_group('News').count(), 1)
+        
+        # the groupings are not fetched again for unknown groupings
+        subscription.set_interests([{'name': 'Other', 'groups': 'A'}])
+        self.assertEqual(self.chimp.calls.count('listInterestGroupings'), 1)
+    
+    def test_store_masks(self):
+        """ Test that the masks of many members are written in bulk. """
+        subscriptions = [self.get_subscription(self.create_user('masks%d' % i,
+                                            UserSubscription.SUBSCRIBED))
+                         for i in range(3)]
+        subscriptions[1].set_interests([{'id': 1, 'groups': 'Deals\\, Promos'}])
+        news = [subscription.get_interest_masks([{'id': 1, 'groups': 'News'}])
+                for subscription in subscriptions]
+        with self.assertNumQueries(3):
+            # read, one update and one insert
+            MemberInterests.objects.store(zip(subscriptions, news))
+        self.assertEqual(MemberInterests.objects.group_counts(),
+                         {'News': 3, 'Deals, Promos': 0})
+        deals = subscriptions[0].get_interest_masks([{'name': 'Interests', 
+                                              'groups': 'Deals\\, Promos'}])
+        with self.assertNumQueries(2):
+            MemberInterests.objects.store([(subscription, deals) for 
+                                           subscription in subscriptions], 
+                                          replace=False)
+        self.assertEqual(MemberInterests.objects.group_counts(),
+                         {'News': 3, 'Deals, Promos': 3})
+
+
+class AsyncCallTestCase(FakeChimpTestCase):
+    """ Test case for the background API calls of UserSubscription. """
+    def test_subscribe_and_sync(self):
+        """ Test that the results are saved by the thread calling get(). """
+        user = self.create_user('async')
+        subscription = self.get_subscription(user)
+        pending = subscription.asubscribe(double_optin=False)
+        self.assertTrue(pending.get(1))
+        self.assertTrue(pending.ready())
+        self.assertEqual(self.get_subscription(user).status,
+                         UserSubscription.SUBSCRIBED)
+        self.assertEqual(self.chimp.calls, ['listSubscribe'])
+
+        # nothing has changed, so no call is made
+        self.assertTrue(subscription.asubscribe(double_optin=False).get())
+        self.assertEqual(self.chimp.calls, ['listSubscribe'])
+
+        self.chimp.members[(self.list_id, user.email)]['status'] = 'cleaned'
+        data, = gather(subscription.async_sync(), timeout=1)
+        self.assertEqual(data['status'], 'cleaned')
+        self.assertEqual(self.get_subscription(user).status,
+                         UserSubscription.CLEANED)
+
+
+class SyncTestCase(FakeChimpTestCase):
+    """ Test case for SyncEngine and the chimpsync command. """
+    def test_unknown_list(self):
+        """ Test that no subscriptions are created for an unknown list. """
+        self.create_user('sync')
+        engine = SyncEngine()
+        self.assertRaises(MailChimpError, engine.ensure_subscriptions, 'typo')
+        self.assertRaises(SystemExit, call_command, 'chimpsync', 
+                          lists=['typo'], stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(UserSubscription.objects.filter(list_id='typo')
+                                                 .exists())
+        self.chimp.add_member('other', 'someone@example.com', 'subscribed')
+        self.assertEqual(engine.ensure_subscriptions('other'), 1)
+    
+    def test_users_loaded_by_caller(self):
+        """ Test that concurrent calls do not query from worker threads. """
+        user = self.create_user('lists')
+        UserSubscription.objects.get_for_user(user, list_id='other')
+        for list_id in (self.list_id, 'other'):
+            self.chimp.add_member(list_id, user.email, 'subscribed')
+        engine = SyncEngine(max_connections=2)
+        try:
+            results = engine.sync_batch(list(UserSubscription.objects.filter(
+                                                                user=user)))
+        finally:
+            engine.close()
+        self.assertEqual([error for subscription, error in results], 
+                         [None, None])
+        self.assertEqual(self.chimp.calls.count('listMemberInfo'), 2)
+    
+    def test_time_budget(self):
+        """ Test that only full runs stopped by the budget are resumed. """
+        self.create_user('sync', UserSubscription.SUBSCRIBED)
+        output = {'stdout': StringIO(), 'stderr': StringIO()}
+        call_command('chimpsync', stale=5, time_budget=0, **output)
+        checkpoint = SyncCheckpoint.objects.get()
+        self.assertEqual((checkpoint.mode, checkpoint.finished, 
+                          checkpoint.stopped), 
+                         (SyncCheckpoint.STALE, False, True))
+        self.assertRaises(SystemExit, call_command, 'chimpsync', resume=True,
+                          **output)
+        
+        call_command('chimpsync', time_budget=0, **output)
+        call_command('chimpsync', resume=True, **output)
+        checkpoint = SyncCheckpoint.objects.get(mode=SyncCheckpoint.FULL)
+        self.assertEqual((checkpoint.finished, checkpoint.stopped, 
+                          checkpoint.processed), (True, False, 1))
+    
+    def test_select_stale(self):
+        """ Test that the most volatile subscriptions are chosen first. """
+        for i, change_count in enumerate((0, 1, 50, 3)):
+            user = self.create_user('stale%d' % i, UserSubscription.SUBSCRIBED)
+            UserSubscription.objects.filter(user=user).update(
+                change_count=change_count, last_synced=datetime(2012, 1, i + 1))
+        pks = SyncEngine().select_stale(3)
+        self.assertEqual([UserSubscription.objects.get(pk=pk).user.username 
+                          for pk in pks], ['stale2', 'stale3', 'stale0'])
+    
+    def test_resume_lists(self):
+        """ Test that a resumed run syncs the lists of the original run. """
+        user = self.create_user('sync', UserSubscription.SUBSCRIBED)
+        self.chimp.add_member('other', 'someone@example.com', 'subscribed')
+        output = {'stdout': StringIO(), 'stderr': StringIO()}
+        call_command('chimpsync', lists=['other'], time_budget=0, **output)
+        self.assertRaises(SystemExit, call_command, 'chimpsync', resume=True,
+                          lists=[self.list_id], **output)
+        call_command('chimpsync', resume=True, **output)
+        checkpoint = SyncCheckpoint.objects.get()
+        self.assertEqual((checkpoint.get_lists(), checkpoint.finished,
+                          checkpoint.processed), (['other'], True, 1))
+        self.assertEqual(self.get_subscription(user).last_synced, None)
+    
+    def test_created_read_from_primary(self):
+        """ Test that a run that creates subscriptions reads from --database. """
+        user = self.create_user('sync', UserSubscription.SUBSCRIBED)
+        UserSubscription.objects.filter(user=user).delete()
+        self.chimp.add_member(self.list_id, user.email, 'unsubscribed')
+        # the alias of the replica does not even exist
+        call_command('chimpsync', read_database='replica', stdout=StringIO(),
+                     stderr=StringIO())
+        self.assertEqual(self.get_subscription(user).status,
+                         UserSubscription.UNSUBSCRIBED)
+
+
+class ReconcileTestCase(FakeChimpTestCase):
+    """ Test case for the reconciliation of the list with the local rows. """
+    def setUp(self):
+        super(ReconcileTestCase, self).setUp()
+        self.missing = self.create_user('missing', UserSubscription.SUBSCRIBED)
+        self.changed = self.create_user('changed', UserSubscription.SUBSCRIBED)
+        self.same = self.create_user('same', UserSubscription.SUBSCRIBED)
+        self.chimp.add_member(self.list_id, self.changed.email, 'unsubscribed')
+        self.chimp.add_member(self.list_id, self.same.email, 'subscribed')
+        self.chimp.add_member(self.list_id, 'orphan@example.com', 'subscribed')
+    
+    def test_differences(self):
+        """ Test that the differences are found in both directions. """
+        reconciliation = Reconciliation(page_size=1).run()
+        self.assertEqual(list(reconciliation.missing_emails()), 
+                         [self.missing.email])
+        self.assertEqual(reconciliation.orphans, ['orphan@example.com'])
+        self.assertEqual(reconciliation.mismatched, 
+                         [(self.get_subscription(self.changed).pk, 
+                           self.changed.email, UserSubscription.SUBSCRIBED, 
+                           UserSubscription.UNSUBSCRIBED)])
+    
+    def test_apply(self):
+        """ Test that missing subscribers must confirm unless told not to. """
+        reconciliation = Reconciliation().run()
+        self.assertEqual(reconciliation.apply(), 1)
+        member = self.chimp.members[(self.list_id, self.missing.email)]
+        self.assertEqual(member['status'], 'pending')
+        self.assertEqual(self.get_subscription(self.missing).status,
+                         UserSubscription.PENDING)
+        self.assertEqual(self.get_subscription(self.changed).status,
+                         UserSubscription.UNSUBSCRIBED)
+        self.assertTrue(('orphan@example.com' in 
+                         [email for list_id, email in self.chimp.members]))
+        
+        # the pending member is not pushed again
+        self.assertEqual(Reconciliation().run().missing, [])
         
+        self.chimp.members.clear()
+        reconciliation = Reconciliation().run()
+        self.assertEqual(len(reconciliation.missing), 1)
+        reconciliation.apply(double_optin=False, prune=True)
+        member = self.chimp.members[(self.list_id, self.same.email)]
+        self.assertEqual(member['status'], 'subscribed')
+
+
+class ActivityTestCase(FakeChimpTestCase):
+    """ Test case for storing the activity of the members. """
+    def test_ingest(self):
+        """ Test that errors for some addresses do not fail the others. """
+        active = self.create_user('active', UserSubscription.SUBSCRIBED)
+        self.create_user('gone', UserSubscription.SUBSCRIBED)
+        member = self.chimp.add_member(self.list_id, active.email, 
+                                       'subscribed')
+        member['activity'] = [{'action': 'open', 'unique_id': 'abc',
+                               'timestamp': '2012-05-01 10:00:00'}]
+        self.assertEqual(MemberActivity.objects.ingest(), (1, []))
+        self.assertEqual(MemberActivity.objects.ingest(), (0, []))
+        
+        self.chimp.listMemberActivity = lambda params: {'data': []}
+        created, errors = MemberActivity.objects.ingest()
+        self.assertEqual(created, 0)
+        self.assertTrue(isinstance(errors[0], MailChimpTransportError))
+
+
+class BatchingTestCase(FakeChimpTestCase):
+    """ Test case for OperationBatch. """
+    def test_merge_rules(self):
+        """ Test that redundant operations are combined. """
+        users = [self.create_user('batch%d' % i) for i in range(3)]
+        folded, replaced, synced = [self.get_subscription(user) 
+                                    for user in users]
+        with OperationBatch() as batch:
+            folded.subscribe(merge_vars={'A': '1'})
+            folded.update(merge_vars={'B': '2'})
+            replaced.subscribe()
+            replaced.unsubscribe()
+            synced.sync()
+            synced.subscribe()
+            operations = dict((user_id, ops) for (list_id, user_id), ops 
+                              in batch._operations.items())
+            self.assertEqual(self.chimp.calls, [])
+        self.assertEqual(operations[folded.user_id]['subscribe'], 
+                         {'merge_vars': {'A': '1', 'B': '2'},
+                          'update_existing': True})
+        self.assertEqual(sorted(operations[replaced.user_id]), 
+                         ['subscription', 'unsubscribe'])
+        self.assertEqual(sorted(operations[synced.user_id]), 
+                         ['subscribe', 'subscription'])
+    
+    def test_flush(self):
+        """ Test that the operations are sent in as few calls as possible. """
+        users = [self.create_user('flush%d' % i) for i in range(5)]
+        subscriptions = [self.get_subscription(user) for user in users]
+        self.chimp.add_member(self.list_id, users[2].email, 'subscribed')
+        self.chimp.add_member(self.list_id, users[4].email, 'cleaned')
+        subscriptions[2].status = UserSubscription.SUBSCRIBED
+        with OperationBatch():
+            subscriptions[0].subscribe(double_optin=False)
+            subscriptions[1].subscribe(double_optin=False)
+            subscriptions[1].unsubscribe()
+            subscriptions[2].update(email_type='text')
+            subscriptions[3].subscribe(double_optin=False, send_welcome=True)
+            subscriptions[4].sync()
+        self.assertEqual(sorted(self.chimp.calls), 
+                         ['listBatchSubscribe', 'listBatchUnsubscribe',
+                          'listMemberInfo', 'listSubscribe', 
+                          'listUpdateMember'])
+        statuses = [self.get_subscription(user).status for user in users]
+        self.assertEqual(statuses, [UserSubscription.SUBSCRIBED, 
+                                    UserSubscription.UNSUBSCRIBED,
+                                    UserSubscription.SUBSCRIBED,
+                                    UserSubscription.SUBSCRIBED,
+                                    UserSubscription.CLEANED])
+
+
+class PendingFlushTestCase(FakeChimpTestCase):
+    """ Test case for PendingUserSubscription.objects.flush(). """
+    def test_flush(self):
+        """ Test that pending rows are kept only for failed subscriptions. """
+        for name in ('pending0', 'pending1', 'invalid'):
+            PendingUserSubscription.objects.create(user=self.create_user(name),
+                merge_vars={'OPTIN_IP': '10.0.0.1'})
+        self.assertRaises(TypeError, PendingUserSubscription.objects.flush,
+                          send_welcome=True)
+        subscribed, errors = PendingUserSubscription.objects.flush(
+                                        chunk_size=2, double_optin=False)
+        self.assertEqual((subscribed, len(errors)), (2, 1))
+        self.assertEqual(self.chimp.calls, ['listBatchSubscribe'] * 2)
+        self.assertEqual(list(PendingUserSubscription.objects.values_list(
+                            'user__username', flat=True)), ['invalid'])
+        subscription = UserSubscription.objects.get(
+                            user__username='pending1', list_id=self.list_id)
+        self.assertEqual((subscription.status, subscription.optin_ip),
+                         (UserSubscription.SUBSCRIBED, '10.0.0.1'))
+        self.assertEqual(UserSubscription.objects.get(
+                            user__username='invalid').status, 
+                         UserSubscription.UNKNOWN)
+
+
+class StatusCacheTestCase(FakeChimpTestCase):
+    """ Test case for the cached subscription statuses. """
+    def test_write_through(self):
+        """ Test that saved statuses are read from the cache. """
+        user = self.create_user('cached')
+        subscription = self.get_subscription(user)
+        subscription.subscribe(double_optin=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(UserSubscription.objects.get_cached_status(user),
+                             UserSubscription.SUBSCRIBED)
+        subscription.unsubscribe()
+        with self.assertNumQueries(0):
+            self.assertEqual(UserSubscription.objects.get_cached_status(user),
+                             UserSubscription.UNSUBSCRIBED)
+        subscription.status = UserSubscription.CLEANED
+        subscription.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(UserSubscription.objects.get_cached_status(user),
+                             UserSubscription.CLEANED)
+    
+    def test_bulk_write_through(self):
+        """ Test that statuses changed in bulk are read from the cache. """
+        users = [self.create_user('bulk%d' % i) for i in range(3)]
+        for user in users:
+            PendingUserSubscription.objects.create(user=user)
+        PendingUserSubscription.objects.flush(double_optin=False)
+        with self.assertNumQueries(0):
+            statuses = UserSubscription.objects.get_cached_statuses(users)
+        self.assertEqual(statuses, dict((user.pk, UserSubscription.SUBSCRIBED)
+                                        for user in users))
+        subscription = self.get_subscription(users[0])
+        subscription.status = UserSubscription.CLEANED
+        SyncEngine().save_changed([subscription])
+        with self.assertNumQueries(0):
+            self.assertEqual(UserSubscription.objects.get_cached_status(
+                                users[0]), UserSubscription.CLEANED)
+
+
+class MemoTestCase(FakeChimpTestCase):
+    """ Test case for the subscriptions attached to users. """
+    def test_attach_to(self):
+        """ Test that the subscriptions of many users take one query. """
+        users = [self.create_user('memo%d' % i, UserSubscription.SUBSCRIBED)
+                 for i in range(3)]
+        users = list(User.objects.filter(pk__in=[user.pk for user in users]))
+        with self.assertNumQueries(1):
+            self.assertEqual([is_subscribed(user) for user 
+                              in with_subscriptions(users)], [True] * 3)
+        User.objects.bulk_create([User(username='chunk%d' % i) 
+                                  for i in range(501)])
+        users = list(User.objects.all())
+        with self.assertNumQueries(2):
+            UserSubscription.objects.attach_to(users)
+    
+    def test_memo(self):
+        """ Test that subscriptions are loaded once per request. """
+        user = self.create_user('memo', UserSubscription.SUBSCRIBED)
+        memo.activate()
+        try:
+            with self.assertNumQueries(1):
+                UserSubscription.objects.attach_to([user])
+            users = list(User.objects.all())
+            with self.assertNumQueries(0):
+                self.assertEqual([is_subscribed(user) for user 
+                                  in with_subscriptions(users)], [True])
+        finally:
+            memo.deactivate()
+
+
+class PushMergeVarsTestCase(FakeChimpTestCase):
+    """ Test case for UserSubscription.objects.push_merge_vars(). """
+    def test_push(self):
+        """ Test that changed merge vars are pushed in bulk, once. """
+        for i in range(3):
+            user = self.create_user('push%d' % i, UserSubscription.SUBSCRIBED)
+            self.chimp.add_member(self.list_id, user.email, 'subscribed')
         
+        def build_merge_vars(user):
+            if user.username == 'push2':
+                return None
+            return {'PLAN': 'pro', 
+                    'GROUPINGS': [{'name': 'Interests', 'groups': 'News'}]}
         
+        self.assertEqual(UserSubscription.objects.push_merge_vars(
+                            build_merge_vars), (2, []))
+        self.assertEqual(self.chimp.calls.count('listBatchSubscribe'), 1)
+        fingerprints = set(UserSubscription.objects.exclude(
+                            user__username='push2').values_list(
+                            'merge_fingerprint', flat=True))
+        self.assertEqual(len(fingerprints), 1)
+        self.assertNotEqual(fingerprints, set(['']))
+        self.assertEqual(MemberInterests.objects.group_counts()['News'], 2)
         
+        self.assertEqual(UserSubscription.objects.push_merge_vars(
+                            build_merge_vars), (0, []))
+        self.assertEqual(self.chimp.calls.count('listBatchSubscribe'), 1)
+
+
+class PreferencesTestCase(FakeChimpTestCase):
+    """ Test case for the preferences view. """
+    urls = 'chimpusers.urls'
+    
+    def setUp(self):
+        super(PreferencesTestCase, self).setUp()
+        user = self.create_user('prefs', UserSubscription.SUBSCRIBED)
+        user.set_password('secret')
+        user.save()
+        self.chimp.add_member(self.list_id, user.email, 'subscribed')
+        self.client.login(username='prefs', password='secret')
+    
+    def post(self, data, **extra):
+        return self.client.post('/preferences/', data, 
+                                content_type='application/json', **extra)
+    
+    def test_get_and_post(self):
+        """ Test revalidation and changing the selected groups. """
+        response = self.client.get('/preferences/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.client.get('/preferences/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        
+        change = '{"groupings": [{"name": "Interests", "groups": ["News"]}]}'
+        self.assertEqual(self.post(change, HTTP_IF_MATCH='"other"')
+                             .status_code, 412)
+        response = self.post(change, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['groupings'][0]
+                             ['selected'], ['News'])
+        member = self.chimp.members[(self.list_id, 'prefs@example.com')]
+        self.assertEqual(member['merges']['GROUPINGS'][0]['groups'], 'News')
+    
+    def test_api_failure(self):
+        """ Test that failed API calls are not reported as client errors. """
+        def timeout(params):
+            raise MailChimpTimeout("slow")
+        def unreachable(params):
+            raise MailChimpTransportError("down")
+        change = '{"groupings": [{"name": "Interests", "groups": ["News"]}]}'
+        for handler, status in ((timeout, 504), (unreachable, 503), 
+                                (lambda params: {'error': 'No', 'code': -50}, 
+                                 502)):
+            self.chimp.listUpdateMember = handler
+            response = self.post(change)
+            self.assertEqual(response.status_code, status)
+            self.assertTrue('error' in json.loads(response.content))
+    
+    def test_invalid_post(self):
+        """ Test that malformed changes are rejected with a 400 response. """
+        for data in ('nope', '[1]', '{"groupings": 5}', '{"groupings": [5]}',
+                     '{"groupings": [{"id": [1]}]}',
+                     '{"groupings": [{"id": 1, "groups": 5}]}',
+                     '{"groupings": [{"id": 1, "groups": [{}]}]}',
+                     '{"groupings": [{"id": 1, "groups": ["Nope"]}]}'):
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400, data)
+            self.assertTrue('error' in json.loads(response.content))
+        self.assertFalse('listUpdateMember' in self.chimp.calls)
+
+
+class ImportTestCase(TestCase):
+    """ Test case for the chimpimport command. """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+    
+    def tearDown(self):
+        os.remove(self.path)
+    
+    def test_import(self):
+        """ Test that empty values are kept and malformed rows skipped. """
+        for name in ('kept', 'set', 'bad'):
+            User.objects.create_user(name, '%s@example.com' % name)
+        UserSubscription.objects.filter(user__username='kept').update(
+            optin_ip='10.0.0.1', optin_time=datetime(2011, 1, 1))
+        with open(self.path, 'wb') as f:
+            f.write("Email Address,OPTIN_TIME,OPTIN_IP\n"
+                    "kept@example.com,,\n"
+                    "set@example.com,2012-03-04 05:06:07,10.0.0.2\n"
+                    "bad@example.com,yesterday,10.0.0.3\n")
+        stderr = StringIO()
+        call_command('chimpimport', self.path, status='subscribed', 
+                     stdout=StringIO(), stderr=stderr)
+        self.assertTrue('line 4' in stderr.getvalue())
+        statuses = dict(UserSubscription.objects.values_list(
+                            'user__username', 'status'))
+        self.assertEqual(statuses['bad'], UserSubscription.UNKNOWN)
+        kept = UserSubscription.objects.get(user__username='kept')
+        self.assertEqual((kept.status, kept.optin_ip), 
+                         (UserSubscription.SUBSCRIBED, '10.0.0.1'))
+        self.assertEqual(kept.optin_time.year, 2011)
+        added = UserSubscription.objects.get(user__username='set')
+        self.assertEqual(added.optin_ip, '10.0.0.2')
+
+
+class ExportTestCase(TestCase):
+    """ Test case for the chimpexport command. """
+    def setUp(self):
+        optins = {'jan': datetime(2012, 1, 1), 'feb': datetime(2012, 2, 1),
+                  'left': datetime(2012, 1, 15), 'none': None}
+        for name in ('jan', 'feb', 'left', 'none'):
+            User.objects.create_user(name, '%s@example.com' % name)
+            status = UserSubscription.SUBSCRIBED
+            if name == 'left':
+                status = UserSubscription.UNSUBSCRIBED
+            UserSubscription.objects.filter(user__username=name).update(
+                status=status, optin_time=optins[name])
+        self.path = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+        os.rmdir(self.path)
+    
+    def test_csv(self):
+        """ Test that every row is exported in chunks of --chunk-size. """
+        stdout = StringIO()
+        # two chunks of rows and the empty one that ends the export
+        with self.assertNumQueries(3):
+            call_command('chimpexport', chunk_size=3, stdout=stdout)
+        rows = list(csv.reader(StringIO(stdout.getvalue())))
+        self.assertEqual(rows[0], ['email', 'list_id', 'status', 
+                                   'optin_time', 'optin_ip'])
+        self.assertEqual([(row[0], row[2]) for row in rows[1:]],
+                         [('jan@example.com', 'Subscribed'), 
+                          ('feb@example.com', 'Subscribed'),
+                          ('left@example.com', 'Unsubscribed'),
+                          ('none@example.com', 'Subscribed')])
+        self.assertEqual((rows[1][3], rows[4][3]), ('2012-01-01 00:00:00', ''))
+    
+    def test_ndjson_filters(self):
+        """ Test that --status, --since and --until filter the rows. """
+        stdout = StringIO()
+        call_command('chimpexport', format='ndjson', statuses=['subscribed'],
+                     since='2012-01-01', until='2012-02-01', stdout=stdout)
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([(row['email'], row['status'], row['optin_time']) 
+                          for row in rows],
+                         [('jan@example.com', 'Subscribed', 
+                           '2012-01-01T00:00:00')])
+        self.assertRaises(SystemExit, call_command, 'chimpexport', 
+                          since='January', stdout=StringIO(), 
+                          stderr=StringIO())
+    
+    def test_gzip(self):
+        """ Test that an output file ending with .gz is gzipped. """
+        path = os.path.join(self.path, 'export.csv.gz')
+        call_command('chimpexport', output=path, statuses=['unsubscribed'],
+                     stdout=StringIO())
+        f = gzip.open(path, 'rb')
+        try:
+            rows = list(csv.reader(f))
+        finally:
+            f.close()
+        self.assertEqual([row[0] for row in rows], 
+                         ['email', 'left@example.com'])
+
+
+class TransportTestCase(unittest.TestCase):
+    """ Test case for recording and replaying API responses. """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        os.remove(self.path)
+    
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    
+    def test_record_replay(self):
+        """ Test that recorded responses are replayed in order. """
+        recorder = RecordingTransport(self.path, CountingTransport())
+        client = MailChimpClient('abc-us2', recorder)
+        self.assertEqual(client.host, 'us2.api.mailchimp.com')
+        client.listMemberInfo(id='1', email_address=['a@example.com'])
+        client.listMemberInfo(id='1', email_address=['a@example.com'])
+        client.lists()
+        recorder.flush()
+        self.assertEqual(client.calls, 3)
+        
+        client = MailChimpClient('xyz-us2', ReplayTransport(self.path))
+        r = client.listMemberInfo(id='1', email_address=['a@example.com'])
+        self.assertEqual(r['count'], 1)
+        r = client.listMemberInfo(id='1', email_address=['a@example.com'])
+        self.assertEqual(r['count'], 2)
+        r = client.listMemberInfo(id='1', email_address=['a@example.com'])
+        self.assertEqual(r['count'], 2)
+        self.assertEqual(client.lists()['count'], 3)
+        self.assertRaises(MailChimpTransportError, client.listMemberInfo, 
+                          id='2', email_address=['a@example.com'])
+
+
+class StubConnection(object):
+    """ Stands in for an httplib connection with a fixed response. """
+    sock = None
+    
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        self.closed = False
+    
+    def request(self, method, url, body, headers):
+        pass
+    
+    def getresponse(self):
+        response = StringIO(self.body)
+        response.status = self.status
+        response.reason = 'Reason'
+        return response
+    
+    def close(self):
+        self.closed = True
+
+
+class HTTPTransportTestCase(unittest.TestCase):
+    """ Test case for the handling of HTTP responses. """
+    def request(self, status, body):
+        transport = HTTPTransport()
+        connection = StubConnection(status, body)
+        transport._local.connections = {'us1.api.mailchimp.com': connection}
+        try:
+            return transport.request('us1.api.mailchimp.com', 'lists', {})
+        finally:
+            self.closed = connection.closed
+    
+    def test_responses(self):
+        """ Test that only JSON responses and API errors are returned. """
+        self.assertEqual(self.request(200, '{"total": 0}'), {'total': 0})
+        self.assertFalse(self.closed)
+        self.assertEqual(self.request(500, '{"error": "Nope", "code": 104}'),
+                         {'error': 'Nope', 'code': 104})
+        self.assertTrue(self.closed)
+        self.assertRaises(MailChimpTransportError, self.request, 502, 
+                          '<html>Bad Gateway</html>')
+        self.assertTrue(self.closed)
+        self.assertRaises(MailChimpTransportError, self.request, 503, '{}')
+        self.assertRaises(MailChimpTransportError, self.request, 200, 'nope')
+
+
+class FakeClock(object):
+    """ Stands in for the time module; sleeping advances the clock. """
+    def __init__(self, now):
+        self.now = now
+    
+    def time(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        self.now += seconds
+
+class SchedulerTestCase(unittest.TestCase):
+    """ Test case for scheduling interactive and bulk calls. """
+    def test_priority_propagation(self):
+        """ Test that the priority class follows calls to worker threads. """
+        self.assertEqual(get_priority(), INTERACTIVE)
+        with priority(BULK):
+            self.assertEqual(call_async(get_priority).get(), BULK)
+        self.assertEqual(call_async(get_priority).get(), INTERACTIVE)
+        
+    def test_bulk_yields(self):
+        """ Test that bulk calls leave room for interactive calls. """
+        clock = FakeClock(100.5)
+        scheduler = Scheduler(10, 0.5)
+        scheduler.KEY_PREFIX = 'chimpusers:test:%s' % id(self)
+        scheduler._incr(scheduler._key('interactive', 99))
+        scheduler._incr(scheduler._key('interactive', 99))
+        original, chimpusers.scheduler.time = chimpusers.scheduler.time, clock
+        try:
+            for i in range(3):
+                scheduler.acquire(BULK)
+            self.assertEqual(clock.now, 100.5)
+            scheduler.acquire(INTERACTIVE)
+            scheduler.acquire(BULK)
+            self.assertEqual(clock.now, 101.0)
+        finally:
+            chimpusers.scheduler.time = original
+    
+    def test_deadline(self):
+        """ Test that calls time out by the deadline of the operation. """
+        transport = CountingTransport()
+        client = MailChimpClient('abc-us2', transport, timeout=10, 
+                                 timeouts={'listMemberInfo': 2})
+        client.lists()
+        client.listMemberInfo(id='1', email_address=['a@example.com'])
+        self.assertEqual(transport.timeouts, [10, 2])
+        with deadline(0.5):
+            client.lists()
+            self.assertTrue(0 < transport.timeouts[-1] <= 0.5)
+            self.assertEqual(call_async(client.lists).get()['count'], 4)
+            self.assertTrue(0 < transport.timeouts[-1] <= 0.5)
+        with deadline(0):
+            self.assertRaises(MailChimpTimeout, client.lists)
+            self.assertRaises(MailChimpTimeout, gather, call_async(time.sleep, 1))
+        self.assertEqual(transport.count, 4)
@@ -0,0 +1,7 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('chimpusers.views',
+    url(r'^preferences/$', 'preferences', name='chimpusers_preferences'),
+    url(r'^preferences/(?P<list_id>\w+)/$', 'preferences', 
+        name='chimpusers_list_preferences'),
+)
@@ -1,15 +1,88 @@
+import hashlib
+import threading
+from datetime import datetime
+from itertools import islice
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
-from chimpusers.exceptions import MailChimpError
+from django.db import transaction
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.translation import ugettext_lazy as _
+try:
+    from importlib import import_module
+except ImportError:
+    from django.utils.importlib import import_module
+from chimpusers.exceptions import MailChimpError, MailChimpTimeout
+from chimpusers.scheduler import with_call_context, remaining_time
+
+_config = None
+_client = None
+
+def get_config():
+    """
+    Validate the required MailChimp configuration settings and return them as
+    a dict. The settings are only checked the first time; this is done when
+    the app is loaded on Django 1.7+ (see chimpusers.apps).
+    """
+    global _config
+    if _config is None:
+        config = {}
+        for name in ('MAILCHIMP_API_KEY', 'MAILCHIMP_LIST_ID'):
+            if not getattr(settings, name, None):
+                errstr = _("You need to specify %s in your Django settings " \
+                           "file.") % name
+                raise ImproperlyConfigured(errstr)
+            config[name] = getattr(settings, name)
+        _config = config
+    return _config
+
+def reset_config(**kwargs):
+    """ Forget the validated configuration and the client. """
+    global _config, _client
+    _config = None
+    _client = None
 
 def get_list_id():
     """
     Get MAILCHIMP_LIST_ID ID as defined in the configuration settings.
     """
-    if not hasattr(settings, 'MAILCHIMP_LIST_ID'):
-        errstr = _("You need to specify MAILCHIMP_LIST_ID in your " \
-                   "Django settings file.")
-        raise ImproperlyConfigured(errstr)                               
-    return settings.MAILCHIMP_LIST_ID
+    return get_config()['MAILCHIMP_LIST_ID']
+
+def get_client():
+    """
+    Get the chimpusers.client.MailChimpClient shared by the process, based on 
+    MAILCHIMP_API_KEY defined in the configuration settings and using the 
+    transport set by MAILCHIMP_TRANSPORT and MAILCHIMP_TRANSPORT_OPTIONS. The
+    calls are scheduled against MAILCHIMP_CALLS_PER_SECOND (default 10), see
+    chimpusers.scheduler, and time out after MAILCHIMP_TIMEOUT seconds 
+    (default 10) or the number of seconds given for the method in the 
+    MAILCHIMP_TIMEOUTS dict. The client is only created the first time this 
+    is called.
+    """
+    global _client
+    if _client is None:
+        from chimpusers.client import MailChimpClient
+        from chimpusers.scheduler import Scheduler
+        path = getattr(settings, 'MAILCHIMP_TRANSPORT', 
+                       'chimpusers.client.HTTPTransport')
+        module_name, class_name = path.rsplit('.', 1)
+        try:
+            transport_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            errstr = _("MAILCHIMP_TRANSPORT '%s' could not be imported.") % path
+            raise ImproperlyConfigured(errstr)
+        options = getattr(settings, 'MAILCHIMP_TRANSPORT_OPTIONS', {})
+        scheduler = Scheduler(
+                        getattr(settings, 'MAILCHIMP_CALLS_PER_SECOND', 10),
+                        getattr(settings, 'MAILCHIMP_BULK_SHARE', 0.8))
+        _client = MailChimpClient(get_config()['MAILCHIMP_API_KEY'], 
+                        transport_class(**options), scheduler,
+                        timeout=getattr(settings, 'MAILCHIMP_TIMEOUT', 10),
+                        timeouts=getattr(settings, 'MAILCHIMP_TIMEOUTS', {}))
+    return _client
+
+# the client has the same interface as mailsnake.MailSnake
+get_mailsnake_instance = get_client
 
 def raise_if_error(response):
         """
@@ -21,4 +94,139 @@ def raise_if_error(response):
                 raise MailChimpError(response['error'], response['code'])
         except TypeError:
             pass
-        
+
+def atomic(using=None):
+    """
+    Returns transaction.atomic() where available (Django 1.6+), otherwise
+    transaction.commit_on_success(), for use as a context manager.
+    """
+    if hasattr(transaction, 'atomic'):
+        return transaction.atomic(using=using)
+    return transaction.commit_on_success(using=using)
+
+def get_error_emails(response):
+    """
+    Get the set of lowercase email addresses reported in the 'errors' of a
+    listBatchSubscribe or listBatchUnsubscribe response.
+    """
+    emails = set()
+    for error in response.get('errors', []):
+        email = error.get('email') or error.get('row', {}).get('EMAIL')
+        if email:
+            emails.add(email.lower())
+    return emails
+
+def parse_timestamp(value):
+    """
+    Convert a 'YYYY-MM-DD HH:MM:SS' timestamp returned by the API, which is in
+    GMT, to a datetime. The datetime is aware if USE_TZ is enabled. Returns
+    None for an empty value.
+    """
+    if not value:
+        return None
+    value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    if getattr(settings, 'USE_TZ', False):
+        from django.utils import timezone
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+def email_hash(email):
+    """
+    Returns a compact 16 byte digest of a normalized email address, suitable
+    as a key when indexing large numbers of members in memory.
+    """
+    email = email.strip().lower()
+    if isinstance(email, unicode):
+        email = email.encode('utf-8')
+    return hashlib.md5(email).digest()
+
+def chunks(iterable, size):
+    """ Yields lists of at most 'size' items from 'iterable'. """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+
+def get_thread_pool():
+    """
+    Get the pool of MAILCHIMP_MAX_CONNECTIONS (default 10) threads shared by 
+    the API calls made in the background with call_async().
+    """
+    global _thread_pool
+    with _thread_pool_lock:
+        if _thread_pool is None:
+            size = getattr(settings, 'MAILCHIMP_MAX_CONNECTIONS', 10)
+            _thread_pool = ThreadPool(size)
+    return _thread_pool
+
+def call_async(func, *args, **kwargs):
+    """
+    Call 'func' in the shared thread pool, with the priority class and the
+    deadline of the current thread. Returns a multiprocessing.pool.AsyncResult
+    whose get() method returns the result or raises the exception of the 
+    call.
+    """
+    return get_thread_pool().apply_async(with_call_context(func), args, kwargs)
+
+
+class AsyncCall(object):
+    """
+    The pending result of an API call made with call_async() whose response
+    is handled by 'callback' in the thread that calls get(), so that model 
+    instances are saved on that thread's database connection and within its
+    transaction. 'result' may be None if no call was needed, in which case 
+    'callback' is passed None.
+    """
+    def __init__(self, result, callback):
+        self.result = result
+        self.callback = callback
+        self._done = False
+        self._value = None
+
+    def ready(self):
+        return self._done or self.result is None or self.result.ready()
+
+    def get(self, timeout=None):
+        """ 
+        Wait for the response and return the result of the callback. Raises
+        the exception of the call or the callback, or MailChimpTimeout. 
+        """
+        if not self._done:
+            response = None
+            if self.result is not None:
+                response = gather(self.result, timeout=timeout)[0]
+            self._value = self.callback(response)
+            self._done = True
+        return self._value
+
+def gather(*results, **kwargs):
+    """
+    Wait for several AsyncResult or AsyncCall objects and return their
+    results in order. Accepts an optional 'timeout' in seconds for each
+    result; by default it waits until the deadline of the current thread, if
+    any. Raises MailChimpTimeout if a result is not ready in time.
+    """
+    timeout = kwargs.get('timeout')
+    values = []
+    for result in results:
+        wait = timeout
+        remaining = remaining_time()
+        if remaining is not None and (wait is None or remaining < wait):
+            wait = remaining
+        try:
+            values.append(result.get(wait))
+        except TimeoutError:
+            raise MailChimpTimeout("No response within %.2f seconds." % wait)
+    return values
+
+try:
+    from django.test.signals import setting_changed
+except ImportError: # Django < 1.4
+    pass
+else:
+    setting_changed.connect(reset_config)
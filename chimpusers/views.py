@@ -0,0 +1,178 @@
+import hashlib
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition, require_http_methods
+from chimpusers.batching import get_current_batch
+from chimpusers.exceptions import MailChimpBaseException, \
+                                  MailChimpTransportError, MailChimpTimeout
+from chimpusers.groups import serialize_groups
+from chimpusers.models import UserSubscription, InterestGrouping, \
+                              MemberInterests
+from chimpusers.utils import get_list_id
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+def _get_preferences(request, list_id=None):
+    """
+    Build the preferences of the current user from the local interest
+    groupings and member interests, without API calls unless the groupings
+    of the list were never stored. Memoized on the request, as it is needed
+    for both the ETag and the response.
+    """
+    list_id = list_id or get_list_id()
+    cached = getattr(request, '_chimpusers_preferences', {})
+    if list_id in cached:
+        return cached[list_id]
+    groupings = list(InterestGrouping.objects.filter(list_id=list_id)
+                                             .order_by('pk'))
+    if not groupings:
+        try:
+            InterestGrouping.objects.refresh(list_id)
+        except MailChimpBaseException:
+            # eg. interest groups are not enabled for the list or the API is
+            # unavailable, the preferences are served without them
+            pass
+        groupings = list(InterestGrouping.objects.filter(list_id=list_id)
+                                                 .order_by('pk'))
+    subscription = UserSubscription.objects.get_memoized(request.user, list_id)
+    masks = {}
+    status = UserSubscription.UNKNOWN
+    if subscription is not None:
+        status = subscription.status
+        masks = dict(MemberInterests.objects.filter(subscription=subscription)
+                                            .values_list('grouping', 'mask'))
+    labels = dict(UserSubscription.CHOICES)
+    preferences = {
+        'list_id': list_id,
+        'status': labels[status].lower().replace(' ', '_'),
+        'groupings': [{
+            'id': grouping.grouping_id,
+            'name': grouping.name,
+            'form_field': grouping.form_field,
+            'groups': [{'bit': bit, 'name': name}
+                       for bit, name in grouping.groups],
+            'selected': grouping.get_index().names_for_mask(
+                                                masks.get(grouping.pk, 0)),
+        } for grouping in groupings],
+    }
+    data = json.dumps(preferences, sort_keys=True, separators=(',', ':'))
+    cached[list_id] = (subscription, groupings, data)
+    request._chimpusers_preferences = cached
+    return cached[list_id]
+
+def _preferences_etag(request, list_id=None):
+    if not request.user.is_authenticated():
+        return None
+    subscription, groupings, data = _get_preferences(request, list_id)
+    return hashlib.sha1(data).hexdigest()
+
+def _json_response(data, status=200):
+    if not isinstance(data, basestring):
+        data = json.dumps(data)
+    response = HttpResponse(data, status=status,
+                            content_type='application/json')
+    # the response depends on the session and must be revalidated
+    patch_cache_control(response, private=True, max_age=0)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+@require_http_methods(['GET', 'HEAD', 'POST'])
+@condition(etag_func=_preferences_etag)
+def preferences(request, list_id=None):
+    """
+    The interest groupings of a list, or the MAILCHIMP_LIST_ID list, and the
+    groups selected by the current user, as JSON:
+
+        {"list_id": "1a2b3c", "status": "subscribed",
+         "groupings": [{"id": 1, "name": "Interests",
+                        "form_field": "checkboxes",
+                        "groups": [{"bit": "1", "name": "News"}, ...],
+                        "selected": ["News"]}]}
+
+    The response is built from the locally stored groupings and interests and
+    has a strong ETag, so clients can revalidate with If-None-Match and get a
+    304 response if nothing changed.
+
+    A POST of {"groupings": [{"id": 1, "groups": ["News"]}]}, where a
+    grouping may be given by "name" instead, changes the selections with
+    UserSubscription.update() and returns the new preferences. An If-Match
+    header makes the change conditional. Invalid changes get a 400 response;
+    if the change could not be made by MailChimp the response is 504 for a 
+    timeout, 503 if MailChimp could not be reached and 502 for an API error,
+    so that clients know they may retry.
+    """
+    if not request.user.is_authenticated():
+        return _json_response({'error': 'Authentication required.'}, 403)
+    if request.method == 'POST':
+        try:
+            error = _update_preferences(request, list_id)
+        except MailChimpTimeout as e:
+            return _json_response({'error': unicode(e)}, 504)
+        except MailChimpTransportError as e:
+            return _json_response({'error': unicode(e)}, 503)
+        except MailChimpBaseException as e:
+            return _json_response({'error': unicode(e)}, 502)
+        if error:
+            return _json_response({'error': error}, 400)
+        request._chimpusers_preferences = {}
+    subscription, groupings, data = _get_preferences(request, list_id)
+    response = _json_response(data)
+    response['ETag'] = '"%s"' % hashlib.sha1(data).hexdigest()
+    return response
+
+def _update_preferences(request, list_id):
+    """ 
+    Apply the changes posted to preferences(). Returns an error if they are 
+    invalid or None. Raises the exceptions of the API call.
+    """
+    subscription, groupings, data = _get_preferences(request, list_id)
+    if subscription is None or subscription.status not in (
+            UserSubscription.SUBSCRIBED, UserSubscription.PENDING):
+        return "You are not subscribed to this list."
+    error = "Expected a JSON object with a 'groupings' list."
+    try:
+        changes = json.loads(request.body)['groupings']
+    except (ValueError, KeyError, TypeError):
+        return error
+    if not isinstance(changes, list) or \
+       [change for change in changes if not isinstance(change, dict)]:
+        return error
+    known = {}
+    for grouping in groupings:
+        known[grouping.grouping_id] = grouping
+        known[grouping.name] = grouping
+    merge_var = []
+    for change in changes:
+        try:
+            grouping = known.get(change.get('id')) or \
+                       known.get(change.get('name'))
+        except TypeError:
+            # an unhashable id or name
+            grouping = None
+        if grouping is None:
+            return "Unknown grouping: %s" % (change.get('id') or
+                                             change.get('name'))
+        names = change.get('groups') or []
+        if not isinstance(names, list) or \
+           [name for name in names if not isinstance(name, basestring)]:
+            return "Expected a list of group names for %s." % grouping.name
+        index = grouping.get_index()
+        for name in names:
+            if name not in index.by_name:
+                return "Unknown group: %s" % name
+        if grouping.form_field != 'checkboxes' and len(names) > 1:
+            return "Only one group can be selected in %s." % grouping.name
+        merge_var.append({'id': grouping.grouping_id,
+                          'groups': serialize_groups(names)})
+    # apply the change now, so that the response shows it
+    batch = get_current_batch()
+    if batch is not None:
+        batch.deactivate()
+    try:
+        subscription.update(merge_vars={'GROUPINGS': merge_var},
+                            replace_interests=True)
+    finally:
+        if batch is not None:
+            batch.activate()
@@ -17,6 +17,9 @@ setup(
     author_email = 'micah@quixotix.com',
     url = 'https://github.com/Quixotix/django-chimpusers',
     packages = find_packages(),
+    package_data = {
+        'chimpusers': ['templates/admin/chimpusers/usersubscription/*.html'],
+    },
     py_modules = ['distribute_setup',],
     license = 'BSD',
     classifiers = [